@@ -1,30 +1,88 @@
+import asyncio
+import logging
 import os
-import requests
 import time
 
+import aiohttp
 from dotenv import load_dotenv
 
 load_dotenv()
 KEY_AIRNOW = os.getenv("KEY-AIRNOW")
 
+AIRNOW_URL = "https://www.airnowapi.org/aq/observation/zipCode/current"
+# outside air is acceptable while the aqi is below this
+AQI_LIMIT = 50
+
+_LOGGER = logging.getLogger(__name__)
+
 
 class AQITracker:
-    def __init__(self):
-        self.last_query_time = time.time()
-        self.payload = {"zipCode": "98005", "format": "application/json", "api_key": KEY_AIRNOW}
-        self.r = requests.get("https://www.airnowapi.org/aq/observation/zipCode/current", params=self.payload)
-        self.aqi = max(self.r.json()[0]["AQI"], self.r.json()[1]["AQI"])
 
-    def aqi_acceptable(self):
-        if time.time() - self.last_query_time > 5:
-            print("getting new aqi value")
-            self.r = requests.get("https://www.airnowapi.org/aq/observation/zipCode/current", params=self.payload)
-            self.aqi = max(self.r.json()[0]["AQI"], self.r.json()[1]["AQI"])
-            self.last_query_time = time.time()
-        else:
-            print("too soon to query")
-        if self.aqi < 50:
-            return True
-        return False
+    # keeps the current aqi from AirNow. a background task refreshes it every
+    # ttl seconds over the shared aiohttp session, and aqi_acceptable only reads
+    # the last value, so the control loop never waits on the http request.
+    # if a refresh fails the last value keeps being served until one succeeds
+
+    # FIELDS
+    #
+    # session: the aiohttp.ClientSession the requests are made with
+    # url: the AirNow endpoint, can point at a local server for testing
+    # payload: the query parameters of the request
+    # ttl: seconds between refreshes
+    # timeout: seconds a single request may take
+    # aqi: the last aqi received, None until the first refresh
+    # last_query_time: the monotonic time of the last successful refresh
+    # task: the background refresh task
+
+    # this is the constructor method
+    def __init__(self, session, zip_code="98005", ttl=600, url=AIRNOW_URL, api_key=KEY_AIRNOW, timeout=10):
+        self.session = session
+        self.url = url
+        self.payload = {"zipCode": zip_code, "format": "application/json"}
+        if api_key is not None:
+            self.payload["api_key"] = api_key
+        self.ttl = ttl
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.aqi = None
+        self.last_query_time = None
+        self.task = None
+
+    async def refresh(self):
+        async with self.session.get(self.url, params=self.payload, timeout=self.timeout) as response:
+            response.raise_for_status()
+            observations = await response.json(content_type=None)
 
+        # there is one observation per pollutant, the worst one counts
+        self.aqi = max(observation["AQI"] for observation in observations)
+        self.last_query_time = time.monotonic()
 
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError) as err:
+                _LOGGER.warning("Could not get the aqi, keeping %s: %s", self.aqi, err)
+            await asyncio.sleep(self.ttl)
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    # seconds since the aqi was last refreshed, None if it never was
+    def age(self):
+        if self.last_query_time is None:
+            return None
+        return time.monotonic() - self.last_query_time
+
+    def aqi_acceptable(self):
+        if self.aqi is None:
+            return False
+        return self.aqi < AQI_LIMIT
@@ -0,0 +1,275 @@
+import asyncio
+import collections
+import logging
+import time
+
+# the number of commands sent to the isy at the same time
+CONCURRENCY = 4
+# seconds one attempt of a command may take before it is tried again
+COMMAND_TIMEOUT = 5
+# seconds a command may spend queued and retried before it is given up
+COMMAND_DEADLINE = 30
+# seconds between two attempts of a command
+RETRY_DELAY = 1
+
+# the priorities of the commands, lower ones are sent first
+URGENT = 0  # turning off a supply or closing the damper
+NORMAL = 1
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Command:
+
+    # FIELDS
+    #
+    # node: the isy node the command is for
+    # level: the level the node is turned on to, 0 for off,
+    #        None for turning it on without a level (e.g. the damper relay)
+    # priority: URGENT or NORMAL
+    # time: the loop time the command was queued
+    # deadline: the loop time the command is given up if it has not gone through
+    # attempts: how many times the command was sent
+
+    __slots__ = ("node", "level", "priority", "time", "deadline", "attempts")
+
+    # this is the constructor method
+    def __init__(self, node, level, priority=NORMAL, time=0):
+        self.node = node
+        self.level = level
+        self.priority = priority
+        self.time = time
+        self.deadline = 0
+        self.attempts = 0
+
+
+# whether a node status already shows the level
+def status_matches(status, level):
+    if level is None:
+        return status != 0
+    return status == level
+
+
+class Actuator:
+
+    # every turn_on / turn_off of the control loop goes through here.
+    # the commands are collected until flush, where repeated and superseded
+    # commands are dropped and the rest are queued. because node.status only
+    # changes once the isy reports back, the last command for every node is
+    # remembered for a debounce window so the same level is not sent again
+    # while the status catches up.
+    #
+    # the queue is worked off by concurrency workers, urgent commands first,
+    # so flush (and the tick) never waits for the isy and a slow request only
+    # holds up one worker. every attempt has a timeout and a failed command is
+    # tried again until its deadline, unless a newer command for the node
+    # replaced it. a node never has two commands on their way at once
+
+    # FIELDS
+    #
+    # debounce: seconds during which a command that was queued is not repeated
+    # concurrency: the number of workers, i.e. of requests to the isy at the same time
+    # timeout: seconds one attempt may take
+    # deadline: seconds a command may take in all
+    # pending: the commands requested since the last flush, keyed by node address
+    # commanded: the last command queued for every node, keyed by node address
+    # queued: the commands waiting for a worker, keyed by node address
+    # in_flight: the addresses of the nodes whose command is being sent right now
+    # queue: the (priority, sequence, command) entries the workers take from. an
+    #        entry whose command is no longer in queued was replaced and is skipped
+    # sequence: counts the entries, so commands of the same priority go in order
+    # workers: the worker tasks, started with the first flush
+    # idle: set while nothing is queued or in flight, see drain
+    # sent: the number of attempts sent to the isy
+    # coalesced: the number of commands that were dropped
+    # retried: the number of attempts that were made again after a failure or timeout
+    # failed: the number of commands that were given up
+    # history: the last commands sent, as (wall clock time, address, level, success)
+    # held: while set, flush drops the pending commands and the queued ones are
+    #       not sent, e.g. while the connection to the isy is down. URGENT
+    #       commands still go through, so the supplies can be turned off
+    # profiler: the profiling.Profiler the round trip of every command is recorded to, if any
+    # recorder: told about every command sent, see replay.Recorder
+    #
+    # the debounce and the deadlines are timed with the monotonic clock of the
+    # loop, so a step of the wall clock (e.g. by ntp) neither gives up queued
+    # commands nor holds back a re-send. replay.py's ReplayLoop moves it to the time of the log
+
+    # this is the constructor method
+    def __init__(self, debounce=2, concurrency=CONCURRENCY, timeout=COMMAND_TIMEOUT, deadline=COMMAND_DEADLINE):
+        self.debounce = debounce
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.deadline = deadline
+        self.pending = {}
+        self.commanded = {}
+        self.queued = {}
+        self.in_flight = set()
+        self.queue = None
+        self.sequence = 0
+        self.workers = []
+        self.idle = None
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.failed = 0
+        self.history = collections.deque(maxlen=50)
+        self.held = False
+        self.profiler = None
+        self.recorder = None
+
+    def turn_on(self, node, level=None, priority=NORMAL):
+        self.request(node, level, priority)
+
+    def turn_off(self, node, priority=NORMAL):
+        self.request(node, 0, priority)
+
+    # a later request for the same node replaces the earlier one
+    def request(self, node, level, priority=NORMAL):
+        if node.address in self.pending:
+            self.coalesced += 1
+        self.pending[node.address] = Command(node, level, priority)
+
+    # whether the command still has to be sent
+    def needed(self, command, now):
+        address = command.node.address
+        last = self.commanded.get(address)
+        on_its_way = address in self.queued or address in self.in_flight
+        recent = last is not None and (on_its_way or now - last.time < self.debounce)
+
+        # the same level was just sent, the status has not caught up yet
+        if recent and last.level == command.level:
+            return False
+
+        # the node is already there and no other level is on its way
+        if status_matches(command.node.status, command.level) and not recent:
+            return False
+
+        return True
+
+    # queues the pending commands that are needed and returns right away
+    async def flush(self):
+        if not self.pending:
+            return
+        now = asyncio.get_running_loop().time()
+        for command in self.pending.values():
+            if self.held and command.priority != URGENT:
+                self.coalesced += 1
+            elif self.needed(command, now):
+                self.enqueue(command, now)
+            else:
+                self.coalesced += 1
+        self.pending = {}
+
+    def enqueue(self, command, now):
+        if not self.workers:
+            self.start()
+        address = command.node.address
+        command.time = now
+        command.deadline = now + self.deadline
+        self.commanded[address] = command
+        if address in self.queued:
+            self.coalesced += 1
+        self.queued[address] = command
+        self.idle.clear()
+        # a node with a command on its way gets the new one once that is done
+        if address not in self.in_flight:
+            self.put(command)
+
+    def put(self, command):
+        self.sequence += 1
+        self.queue.put_nowait((command.priority, self.sequence, command))
+
+    def start(self):
+        self.queue = asyncio.PriorityQueue()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.workers = [asyncio.ensure_future(self.work()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        self.queued = {}
+        self.in_flight = set()
+        if self.idle is not None:
+            self.idle.set()
+
+    # waits until every queued command went through or was given up
+    async def drain(self):
+        if self.idle is not None:
+            await self.idle.wait()
+
+    async def work(self):
+        while True:
+            _, _, command = await self.queue.get()
+            address = command.node.address
+            if self.queued.get(address) is not command or address in self.in_flight:
+                continue
+            del self.queued[address]
+            await self.send(command)
+
+            newer = self.queued.get(address)
+            if newer is not None:
+                self.put(newer)
+            elif not self.queued and not self.in_flight:
+                self.idle.set()
+
+    async def send(self, command):
+        node = command.node
+        address = node.address
+        success = False
+        self.in_flight.add(address)
+        try:
+            while not self.held or command.priority == URGENT:
+                if asyncio.get_running_loop().time() > command.deadline:
+                    _LOGGER.warning("Giving up on the command to %s after %d attempts", address, command.attempts)
+                    break
+                command.attempts += 1
+                self.sent += 1
+                start = time.perf_counter_ns()
+                try:
+                    success = await asyncio.wait_for(self.command(node, command.level), self.timeout)
+                except asyncio.TimeoutError:
+                    _LOGGER.warning("Command to %s timed out", address)
+                    success = False
+                except Exception as err:
+                    _LOGGER.error("Command to %s failed: %s", address, err)
+                    success = False
+                if self.profiler is not None:
+                    self.profiler.record("actuation", time.perf_counter_ns() - start)
+
+                # a newer command for the node replaces the retry
+                if success is not False or address in self.queued:
+                    break
+                self.retried += 1
+                await asyncio.sleep(RETRY_DELAY)
+        finally:
+            self.in_flight.discard(address)
+
+        if not command.attempts:
+            # dropped while held, the next flush after resume decides again
+            self.coalesced += 1
+            if self.commanded.get(address) is command:
+                del self.commanded[address]
+            return
+
+        success = success is not False
+        self.history.append((time.time(), address, command.level, success))
+        if self.recorder is not None:
+            self.recorder.command(address, command.level, success)
+
+        # forget a failed command so the next flush sends it again
+        if not success:
+            self.failed += 1
+            if self.commanded.get(address) is command:
+                del self.commanded[address]
+
+    @staticmethod
+    async def command(node, level):
+        if level == 0:
+            return await node.turn_off()
+        if level is None:
+            return await node.turn_on()
+        return await node.turn_on(level)
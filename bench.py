@@ -0,0 +1,184 @@
+# benchmarks for the control hot path, run against the fake isy.
+#
+# "python3 bench.py" runs every benchmark at 10, 100, 1,000 and 10,000
+# fans/rooms and prints the p50/p99 latency and the memory allocated per call.
+# "--save FILE" keeps the results as a baseline and "--compare FILE" fails
+# when a benchmark got slower than the baseline by more than "--threshold".
+# bench_baseline.json holds the results the current code is compared to
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import humidity
+import main
+from actuator import Actuator
+from cfm import CFMAccumulator
+from fake_isy import FakeISY, synthetic_registry
+from fan import ExhaustFans, SupplyFans
+from fantable import FanTable
+
+SIZES = (10, 100, 1000, 10000)
+
+
+class Site:
+
+    # a controller with its fans and rooms on a fake isy, for one benchmark size
+
+    # FIELDS
+    #
+    # isy: the FakeISY
+    # exhaust_fans_object: the ExhaustFans object
+    # supply_fans_object: the SupplyFans object
+    # humidity_controller: the Humidity object
+    # controller: the main.Controller
+    # toggled: the nodes of the exhaust fans, which toggle goes through in turn
+    # step: how many times toggle was called, so every call changes something
+
+    # this is the constructor method
+    # compact: whether the fans keep their state in a FanTable
+    def __init__(self, size, compact=False):
+        registry = synthetic_registry(fans=size, rooms=size)
+        self.isy = FakeISY.from_registry(registry)
+        accumulator = FanTable() if compact else CFMAccumulator()
+        self.exhaust_fans_object = ExhaustFans(self.isy, registry.exhaust_fans, accumulator)
+        self.supply_fans_object = SupplyFans(self.isy, registry.supplies, accumulator)
+        self.humidity_controller = humidity.Humidity(self.isy, registry, Actuator())
+        self.controller = main.Controller(self.isy, self.exhaust_fans_object, self.supply_fans_object,
+                                          self.humidity_controller)
+        self.toggled = [fan.node for fan in self.exhaust_fans_object.dict.values()]
+        self.step = 0
+
+    # turns one exhaust fan on or off, like a node change between two ticks
+    def toggle(self):
+        node = self.toggled[self.step % len(self.toggled)]
+        node.status = 0 if node.status else 255
+        self.step += 1
+
+    async def fans_update(self):
+        self.toggle()
+        self.exhaust_fans_object.update()
+        self.supply_fans_object.update()
+
+    # one fan changes and the totals are read, like a tick after a single event
+    async def cfm_sums(self):
+        node = self.toggled[self.step % len(self.toggled)]
+        self.toggle()
+        self.exhaust_fans_object.update((node.address,))
+        return self.controller.accumulator.exhaust, self.controller.accumulator.supply
+
+    async def balance_cfm(self):
+        await main.balance_cfm(self.exhaust_fans_object.dict, self.supply_fans_object.dict,
+                               self.controller.accumulator.exhaust, self.controller.planner,
+                               self.controller.actuator)
+
+    async def check_humidity(self):
+        await self.humidity_controller.check_humidity()
+
+    async def tick(self):
+        self.toggle()
+        await self.controller.tick()
+
+
+BENCHMARKS = ("fans_update", "cfm_sums", "balance_cfm", "check_humidity", "tick")
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+# times iterations calls of the benchmark, then measures its allocations
+async def measure(function, iterations):
+    # warm up caches and lazily created state first
+    for _ in range(max(1, iterations // 10)):
+        await function()
+
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter_ns()
+        await function()
+        samples.append(time.perf_counter_ns() - start)
+    samples.sort()
+
+    calls = max(1, iterations // 10)
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        for _ in range(calls):
+            await function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "p50_us": percentile(samples, 0.50) / 1000,
+        "p99_us": percentile(samples, 0.99) / 1000,
+        "alloc_kib": (peak - before) / 1024,
+    }
+
+
+async def run(sizes, benchmarks, iterations, compact=False):
+    results = {}
+    for size in sizes:
+        site = Site(size, compact)
+        # fewer calls for the big sites so a full run stays short
+        count = max(20, iterations * 100 // max(size, 100))
+        for name in benchmarks:
+            result = await measure(getattr(site, name), count)
+            results.setdefault(name, {})[str(size)] = result
+            print("{:<16}{:>7} {:>12.1f} {:>12.1f} {:>12.1f}".format(
+                name, size, result["p50_us"], result["p99_us"], result["alloc_kib"]))
+    return results
+
+
+# prints how every benchmark compares to the baseline.
+# returns the names of the benchmarks that got slower by more than threshold
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, sizes in results.items():
+        for size, result in sizes.items():
+            base = baseline.get(name, {}).get(size)
+            if not base or not base["p50_us"]:
+                continue
+            ratio = result["p50_us"] / base["p50_us"]
+            flag = " REGRESSION" if ratio > threshold else ""
+            print("{:<16}{:>7} {:>8.2f}x{}".format(name, size, ratio, flag))
+            if flag:
+                regressions.append("{}@{}".format(name, size))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the control hot path against a fake isy.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="numbers of fans/rooms")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=BENCHMARKS, help="benchmarks to run")
+    parser.add_argument("--iterations", type=int, default=1000, help="calls per benchmark at 100 fans or fewer")
+    parser.add_argument("--compact", action="store_true", help="keep the fan state in a FanTable")
+    parser.add_argument("--save", help="write the results to this file")
+    parser.add_argument("--compare", help="compare the results to a file written with --save")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="slowdown of the p50 against the baseline that counts as a regression")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    print("{:<16}{:>7} {:>12} {:>12} {:>12}".format("benchmark", "size", "p50 us", "p99 us", "alloc KiB"))
+    results = asyncio.run(run(args.sizes, args.only, args.iterations, args.compact))
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({"python": platform.python_version(), "results": results}, file, indent=4)
+
+    if args.compare:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("Slower than the baseline: " + ", ".join(regressions))
+            sys.exit(1)
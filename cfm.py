@@ -0,0 +1,47 @@
+# returns the cfm a fan is moving at the given value (the status of its isy node)
+def fan_cfm(fan, value):
+    if fan.type == "bool":
+        return value and fan.cfm
+
+    if type(fan.type) == int:
+        if fan.curve is not None:
+            return fan.curve.cfm(value)
+        return round(fan.cfm * value * fan.ratio)
+
+    return 0
+
+
+class CFMAccumulator:
+
+    # keeps running totals of the exhaust and supply cfm.
+    # every fan reports the change of its own cfm when its value changes,
+    # so reading the totals never has to walk the fans
+
+    # FIELDS
+    #
+    # exhaust: the total exhaust cfm
+    # supply: the total supply cfm
+
+    # this is the constructor method
+    def __init__(self):
+        self.exhaust = 0
+        self.supply = 0
+
+    # creates a fan for the spec that reports to this accumulator.
+    # fans_object: the FansDict the fan is for
+    def add_fan(self, fans_object, spec):
+        fan = fans_object.fan_class(fans_object.isy, spec)
+        fan.attach(self)
+        return fan
+
+    # adds the change of one fan's cfm to the total of its kind
+    def add(self, kind, delta):
+        if kind == "exhaust":
+            self.exhaust += delta
+        else:
+            self.supply += delta
+
+    # the cfm the supplies still have to make up for
+    @property
+    def net(self):
+        return self.exhaust - self.supply
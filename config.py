@@ -0,0 +1,252 @@
+import json
+import logging
+import os
+import pickle
+from types import MappingProxyType
+from typing import NamedTuple, Optional, Tuple, Union
+
+CONFIG_PATH = "util.json"
+
+# bump this whenever the layout of the specs changes so old caches are ignored
+CACHE_VERSION = 6
+
+# the roles a supply can have in util.json
+DAMPER = "damper"
+FRESH_AIR_FAN_12_INCH = "fresh_air_12_inch"
+FRESH_AIR_FAN_8_INCH = "fresh_air_8_inch"
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class FanSpec(NamedTuple):
+    # node_name: the name or address used to look the node up in isy.nodes
+    # name: the english name of the fan
+    # cfm: the cfm of the fan
+    # type: "bool" if the fan is on/off, otherwise the number its status is scaled to
+    # kind: "exhaust" or "supply"
+    # role: what the fan is, if anything, e.g. the fresh air damper
+    # the fields below are only used for supplies, see planner.SupplyPlanner
+    # priority: supplies with a lower priority are filled first
+    # min_level: the fraction of its cfm a supply never runs below while it is on
+    # warmup: seconds after the supplies start before this supply may be used
+    # travel: for the damper, the seconds it takes to open or close, see damper.Damper
+    # after_damper: whether this supply draws through the damper and waits until it is open
+    # curve: (level, cfm) pairs measured for a fan with a scale whose cfm is not linear
+    #        in its level, with rising levels ending at type. off is 0 cfm and the cfm
+    #        between two points is interpolated, see curve.FanCurve. empty for linear fans
+    # first_when: (exhaust fan node_name, value) pairs. while one of those exhaust
+    #             fans is at that value this supply is filled before all others
+    node_name: str
+    name: str
+    cfm: int
+    type: Union[str, int]
+    kind: str
+    role: Optional[str] = None
+    priority: int = 0
+    min_level: float = 0
+    warmup: float = 0
+    travel: float = 0
+    after_damper: bool = False
+    curve: Tuple[Tuple[int, float], ...] = ()
+    first_when: Tuple[Tuple[str, int], ...] = ()
+
+
+class RoomSpec(NamedTuple):
+    # see humidity.Room for the meaning of the fields.
+    # hum can also be the name of an isy variable holding the humidity
+    sens_hum: str
+    sens_motion: str
+    fan: str
+    hum: Union[int, str]
+    hum_t: int
+    motion_power: int
+    motion_t: int
+    hum_band: float = 0
+    hum_smooth: float = 0
+    hum_rise: float = 0
+
+
+class Registry:
+
+    # the parsed and validated contents of util.json.
+    # it is built once and shared by fan.py, humidity.py and main.py
+
+    # FIELDS
+    #
+    # exhaust_fans: the FanSpecs of the exhaust fans, in config order
+    # supplies: the FanSpecs of the supplies, in config order
+    # rooms: the RoomSpecs of the rooms with a humidity sensor
+    # fans: every FanSpec keyed by node_name
+    # by_role: the FanSpecs that have a role, keyed by role
+    # variables: the names of the isy variables the specs read thresholds from
+
+    __slots__ = ("exhaust_fans", "supplies", "rooms", "fans", "by_role", "variables")
+
+    # this is the constructor method
+    def __init__(self, exhaust_fans, supplies, rooms):
+        fans = {}
+        by_role = {}
+        for spec in exhaust_fans + supplies:
+            fans[spec.node_name] = spec
+            if spec.role is not None:
+                by_role[spec.role] = spec
+
+        object.__setattr__(self, "exhaust_fans", exhaust_fans)
+        object.__setattr__(self, "supplies", supplies)
+        object.__setattr__(self, "rooms", rooms)
+        object.__setattr__(self, "fans", MappingProxyType(fans))
+        object.__setattr__(self, "by_role", MappingProxyType(by_role))
+        object.__setattr__(self, "variables", frozenset(room.hum for room in rooms if isinstance(room.hum, str)))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Registry is immutable")
+
+    def role(self, role):
+        return self.by_role[role]
+
+    # the node_names of every fan and room node, as util.json names them
+    def node_names(self):
+        names = [spec.node_name for spec in self.exhaust_fans + self.supplies]
+        for room in self.rooms:
+            names.extend((room.sens_hum, room.sens_motion, room.fan))
+        return names
+
+
+def _curve(node_name, fan_type, points):
+    try:
+        curve = tuple((level, cfm) for level, cfm in points)
+    except (TypeError, ValueError):
+        raise ValueError("{} has an invalid curve: {!r}".format(node_name, points)) from None
+    if not curve:
+        return curve
+    if fan_type == "bool":
+        raise ValueError("{} has a curve but no scale".format(node_name))
+
+    last_level, last_cfm = 0, 0
+    for level, cfm in curve:
+        if type(level) != int or not last_level < level <= fan_type:
+            raise ValueError("{} has an invalid curve level: {!r}".format(node_name, level))
+        if not isinstance(cfm, (int, float)) or cfm < last_cfm:
+            raise ValueError("{} has a curve cfm that is invalid or falls: {!r}".format(node_name, cfm))
+        last_level, last_cfm = level, cfm
+    if last_level != fan_type:
+        raise ValueError("{} has a curve that ends at {}, not {}".format(node_name, last_level, fan_type))
+    return curve
+
+
+# whether value is an int or float, bools are not numbers here
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _fan_specs(file_data, names_key, fans_key, kind):
+    specs = []
+    fans = file_data.get(fans_key, {})
+    for node_name in file_data.get(names_key, []):
+        if node_name not in fans:
+            raise ValueError("{} is listed in {} but missing from {}".format(node_name, names_key, fans_key))
+
+        fan = fans[node_name]
+        fan_type = fan.get("type")
+        if fan_type != "bool" and not (type(fan_type) == int and fan_type > 0):
+            raise ValueError("{} has an invalid type: {!r}".format(node_name, fan_type))
+        if not _is_number(fan.get("cfm")) or fan["cfm"] <= 0:
+            raise ValueError("{} has an invalid cfm: {!r}".format(node_name, fan.get("cfm")))
+        if not _is_number(fan.get("priority", 0)):
+            raise ValueError("{} has an invalid priority: {!r}".format(node_name, fan.get("priority")))
+        if not _is_number(fan.get("min_level", 0)) or not 0 <= fan.get("min_level", 0) <= 1:
+            raise ValueError("{} has an invalid min_level: {!r}".format(node_name, fan.get("min_level")))
+        first_when = fan.get("first_when", {})
+        if not isinstance(first_when, dict) or not all(
+                isinstance(name, str) and _is_number(value) for name, value in first_when.items()):
+            raise ValueError("{} has an invalid first_when, expected exhaust fan names to values: {!r}".format(
+                node_name, first_when))
+        if not isinstance(fan.get("warmup", 0), (int, float)) or fan.get("warmup", 0) < 0:
+            raise ValueError("{} has an invalid warmup: {!r}".format(node_name, fan.get("warmup")))
+        if not isinstance(fan.get("travel", 0), (int, float)) or fan.get("travel", 0) < 0:
+            raise ValueError("{} has an invalid travel: {!r}".format(node_name, fan.get("travel")))
+        if not isinstance(fan.get("after_damper", False), bool):
+            raise ValueError("{} has an invalid after_damper: {!r}".format(node_name, fan.get("after_damper")))
+
+        specs.append(FanSpec(node_name=node_name,
+                             name=fan.get("name", node_name),
+                             cfm=fan["cfm"],
+                             type=fan_type,
+                             kind=kind,
+                             role=fan.get("role"),
+                             priority=fan.get("priority", 0),
+                             min_level=fan.get("min_level", 0),
+                             warmup=fan.get("warmup", 0),
+                             travel=fan.get("travel", 0),
+                             after_damper=fan.get("after_damper", False),
+                             curve=_curve(node_name, fan_type, fan.get("curve", ())),
+                             first_when=tuple(sorted(first_when.items()))))
+    return tuple(specs)
+
+
+def _room_specs(file_data):
+    specs = []
+    for room in file_data.get("honeywell_sens", []):
+        try:
+            spec = RoomSpec(**{field: room[field] for field in RoomSpec._fields
+                               if field in room or field not in RoomSpec._field_defaults})
+        except KeyError as err:
+            raise ValueError("room {} is missing {}".format(room.get("sens_hum"), err.args[0])) from err
+        if not isinstance(spec.hum, (int, float, str)) or isinstance(spec.hum, bool):
+            raise ValueError("room {} has an invalid hum: {!r}".format(spec.sens_hum, spec.hum))
+        for field in ("hum_band", "hum_smooth", "hum_rise"):
+            value = getattr(spec, field)
+            if not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0:
+                raise ValueError("room {} has an invalid {}: {!r}".format(spec.sens_hum, field, value))
+        specs.append(spec)
+    return tuple(specs)
+
+
+# validates the parsed contents of util.json and returns the specs
+def parse(file_data):
+    exhaust_fans = _fan_specs(file_data, "exhaust_fan_node_names", "exhaust_fans", "exhaust")
+    supplies = _fan_specs(file_data, "supply_fan_node_names", "supplies", "supply")
+    return exhaust_fans, supplies, _room_specs(file_data)
+
+
+def _read_cache(cache_path, key):
+    try:
+        with open(cache_path, "rb") as file:
+            cached_key, specs = pickle.load(file)
+    except (OSError, pickle.PickleError, EOFError, ValueError, TypeError):
+        return None
+
+    if cached_key != key:
+        return None
+    return specs
+
+
+def _write_cache(cache_path, key, specs):
+    tmp_path = cache_path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as file:
+            pickle.dump((key, specs), file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as err:
+        _LOGGER.warning("Could not write the config cache %s: %s", cache_path, err)
+
+
+# reads util.json once and builds the registry.
+# if cache_path is given the validated specs are also kept there, keyed by the
+# modification time and size of util.json, and reused while the file is unchanged
+def load_registry(path=CONFIG_PATH, cache_path=None):
+    specs = None
+    key = None
+
+    if cache_path:
+        stat = os.stat(path)
+        key = (CACHE_VERSION, stat.st_mtime_ns, stat.st_size)
+        specs = _read_cache(cache_path, key)
+
+    if specs is None:
+        with open(path, "r") as file:
+            specs = parse(json.load(file))
+        if cache_path:
+            _write_cache(cache_path, key, specs)
+
+    return Registry(*specs)
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import random
+
+from pyisy.constants import (
+    ES_CONNECTED,
+    ES_DISCONNECTED,
+    ES_LOST_STREAM_CONNECTION,
+    ES_RECONNECT_FAILED,
+    ES_RECONNECTING,
+    ES_SYNCING,
+)
+
+# the connection events that mean the node statuses can no longer be trusted
+LOST = (ES_LOST_STREAM_CONNECTION, ES_DISCONNECTED, ES_RECONNECT_FAILED, ES_RECONNECTING)
+# the connection events of a websocket that is up again
+UP = (ES_SYNCING, ES_CONNECTED)
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class ConnectionManager:
+
+    # keeps the control loop going through network hiccups without a full
+    # isy.initialize. when the websocket is lost the controller is put on hold,
+    # so no command is sent based on statuses that may be stale and every fan
+    # stays where it is. the websocket is then started again after a jittered
+    # exponential backoff, and once it is up only the node statuses and
+    # variable values are read again (the node and program tree is kept)
+    # before the controller resumes with a full recompute
+
+    # FIELDS
+    #
+    # isy: the isy object
+    # controller: the main.Controller put on hold while disconnected
+    # backoff_min: seconds waited before the first reconnect attempt
+    # backoff_max: the longest wait between attempts
+    # connect_timeout: seconds a started websocket has to come up in
+    # connected: whether the statuses are current
+    # reconnecting: set while the manager restarts the websocket itself
+    # reconnects: the number of times the connection was restored
+    # lost: set when the connection was lost and has to be restored
+    # up: set when the websocket reports it is up
+    # subscriber: the listener on isy.connection_events
+    # task: the task restoring the connection
+
+    # this is the constructor method
+    def __init__(self, isy, controller, backoff_min=1, backoff_max=120, connect_timeout=30):
+        self.isy = isy
+        self.controller = controller
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.connect_timeout = connect_timeout
+        self.connected = True
+        self.reconnecting = False
+        self.reconnects = 0
+        self.lost = asyncio.Event()
+        self.up = asyncio.Event()
+        self.subscriber = None
+        self.task = None
+
+    def start(self):
+        self.subscriber = self.isy.connection_events.subscribe(self.connection_changed)
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.subscriber is not None:
+            self.subscriber.unsubscribe()
+            self.subscriber = None
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def connection_changed(self, event):
+        if event in UP:
+            self.up.set()
+        elif event in LOST:
+            self.up.clear()
+            # the manager stopping the websocket itself is not a new loss
+            if not self.reconnecting and self.connected:
+                _LOGGER.warning("Lost the connection to the isy (%s), holding the fans", event)
+                self.connected = False
+                self.controller.hold()
+                self.lost.set()
+
+    async def run(self):
+        while True:
+            await self.lost.wait()
+            self.lost.clear()
+            self.reconnecting = True
+            try:
+                await self.reconnect()
+            finally:
+                self.reconnecting = False
+
+    def backoff(self, attempt):
+        delay = min(self.backoff_max, self.backoff_min * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    async def reconnect(self):
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.backoff(attempt))
+            attempt += 1
+
+            # pyisy retries on a fixed schedule of its own, which is replaced by this one
+            self.isy.websocket.stop()
+            self.up.clear()
+            self.isy.websocket.start()
+            try:
+                await asyncio.wait_for(self.up.wait(), self.connect_timeout)
+            except asyncio.TimeoutError:
+                _LOGGER.warning("Reconnect attempt %d to the isy timed out", attempt)
+                continue
+
+            # the websocket is up, so any change from now on arrives as an event.
+            # what changed while it was down is read once from the rest api
+            if await self.resync():
+                break
+            _LOGGER.warning("Reconnect attempt %d could not read the node statuses", attempt)
+
+        self.connected = True
+        self.reconnects += 1
+        _LOGGER.warning("Reconnected to the isy after %d attempts", attempt)
+        self.controller.resume()
+
+    # reads the statuses of the nodes and the values of the variables again.
+    # returns whether they could be read
+    async def resync(self):
+        try:
+            xml = await self.isy.conn.get_status()
+            if xml is None:
+                return False
+            await self.isy.nodes.update(xml=xml)
+            await self.isy.variables.update()
+        except Exception as err:
+            _LOGGER.error("Could not resync the isy: %s", err)
+            return False
+        return True
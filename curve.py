@@ -0,0 +1,63 @@
+import functools
+import math
+
+# the number of entries of the cfm to level table
+INVERSE_SIZE = 256
+
+
+class FanCurve:
+
+    # the measured airflow of a fan with a scale, for fans whose cfm is not
+    # linear in their level (e.g. an ecm fan behind a damper). the points
+    # measured in util.json are interpolated once into a table of the cfm at
+    # every level, and a table of the level for INVERSE_SIZE steps of cfm, so
+    # the cfm totals and the supply plans each take one index per fan
+
+    # FIELDS
+    #
+    # forward: the cfm at every level from 0 to the type of the fan
+    # inverse: the lowest level moving at least i / (INVERSE_SIZE - 1) of max_cfm, for every i
+    # max_cfm: the cfm at the top level
+
+    __slots__ = ("forward", "inverse", "max_cfm")
+
+    # this is the constructor method
+    # points: (level, cfm) pairs with rising levels up to fan_type, see config.FanSpec
+    def __init__(self, points, fan_type):
+        points = ((0, 0),) + tuple(points)
+
+        forward = []
+        i = 0
+        for level in range(fan_type + 1):
+            while points[i + 1][0] < level:
+                i += 1
+            (level_0, cfm_0), (level_1, cfm_1) = points[i], points[i + 1]
+            forward.append(round(cfm_0 + (cfm_1 - cfm_0) * (level - level_0) / (level_1 - level_0)))
+        self.forward = tuple(forward)
+        self.max_cfm = forward[-1]
+
+        inverse = []
+        level = 0
+        for i in range(INVERSE_SIZE):
+            target = self.max_cfm * i / (INVERSE_SIZE - 1)
+            while forward[level] < target:
+                level += 1
+            inverse.append(level)
+        self.inverse = tuple(inverse)
+
+    def cfm(self, level):
+        return self.forward[min(max(int(level), 0), len(self.forward) - 1)]
+
+    # the lowest level that moves at least cfm, rounded up to the next step of the inverse table
+    def level(self, cfm):
+        if cfm <= 0:
+            return 0
+        if cfm >= self.max_cfm:
+            return len(self.forward) - 1
+        return self.inverse[math.ceil(cfm * (INVERSE_SIZE - 1) / self.max_cfm)]
+
+
+# the tables are built once for every curve in util.json and shared by every fan using it
+@functools.lru_cache(maxsize=None)
+def fan_curve(points, fan_type):
+    return FanCurve(points, fan_type)
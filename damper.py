@@ -0,0 +1,87 @@
+import logging
+
+# the states of the damper
+CLOSED = "closed"
+OPENING = "opening"
+OPEN = "open"
+CLOSING = "closing"
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Damper:
+
+    # follows the fresh air damper through its travel. the relay of the damper
+    # switching on or off only starts the damper moving, it is open (or closed)
+    # travel seconds later. a timer on the loop ends the travel and calls
+    # on_change, so the supplies that draw through the damper start the moment
+    # it is open instead of on the next tick that happens to look.
+    # turning the relay around halfway only takes as long as the damper has moved
+
+    # FIELDS
+    #
+    # node_name: the node_name of the damper in util.json
+    # travel: seconds the damper takes from closed to open or back
+    # state: CLOSED, OPENING, OPEN or CLOSING
+    # position: seconds of travel the damper was away from closed when it started moving
+    # since: the loop time the damper started moving
+    # timer: the timer ending the travel, None while the damper stands still
+    # on_change: called with the new state when the damper is open or closed
+
+    # this is the constructor method
+    # on: whether the relay is on, a damper whose relay is already on (e.g. after a restart) is taken as open
+    def __init__(self, spec, on=False, on_change=None):
+        self.node_name = spec.node_name
+        self.travel = spec.travel
+        self.state = OPEN if on else CLOSED
+        self.position = self.travel if on else 0
+        self.since = None
+        self.timer = None
+        self.on_change = on_change
+
+    @property
+    def is_open(self):
+        return self.state == OPEN
+
+    # seconds of travel the damper is away from closed at the loop time now
+    def position_at(self, now):
+        if self.state == OPENING:
+            return min(self.travel, self.position + now - self.since)
+        if self.state == CLOSING:
+            return max(0, self.position - (now - self.since))
+        return self.travel if self.state == OPEN else 0
+
+    # takes the status of the relay, starting the damper moving when it switched
+    def follow(self, on, loop):
+        if on and self.state in (CLOSED, CLOSING):
+            self.move(OPENING, loop)
+        elif not on and self.state in (OPEN, OPENING):
+            self.move(CLOSING, loop)
+
+    def move(self, state, loop):
+        now = loop.time()
+        position = self.position_at(now)
+        self.cancel()
+        self.state = state
+        self.position = position
+        self.since = now
+
+        remaining = self.travel - position if state == OPENING else position
+        _LOGGER.debug("Damper %s %s, %.1fs to go", self.node_name, state, remaining)
+        if remaining <= 0:
+            self.arrived()
+        else:
+            self.timer = loop.call_later(remaining, self.arrived)
+
+    def arrived(self):
+        self.timer = None
+        self.state = OPEN if self.state == OPENING else CLOSED
+        self.position = self.travel if self.state == OPEN else 0
+        _LOGGER.debug("Damper %s %s", self.node_name, self.state)
+        if self.on_change is not None:
+            self.on_change(self.state)
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
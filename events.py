@@ -0,0 +1,79 @@
+import itertools
+import logging
+
+# the most nodes that can have a change pending at once
+CAPACITY = 1024
+# the most pending changes taken by one drain
+BATCH = 256
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class EventBuffer:
+
+    # sits between the pyisy callbacks and the control loop. pyisy calls its
+    # subscribers inside the processing of the websocket, so they only put the
+    # address of the node here and the controller task drains the buffer on its
+    # next tick. a node has at most one pending entry and a later event replaces
+    # the earlier one, so a storm of events (a scene touching many nodes, the
+    # isy rebooting) comes out as one change per node and the buffer never
+    # holds more than capacity entries. an event for a new node while the buffer
+    # is full is dropped and overflowed is set, so the controller re-reads
+    # every node instead of missing the change
+
+    # FIELDS
+    #
+    # capacity: the most entries the buffer holds
+    # entries: the last event of every node with a pending change, keyed by address, oldest first
+    # overflowed: whether an event was dropped since the last drain
+    # received: the number of events put
+    # merged: the number of events that replaced a pending one
+    # dropped: the number of events dropped because the buffer was full
+    # drained: the number of entries taken by drain
+
+    # this is the constructor method
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.entries = {}
+        self.overflowed = False
+        self.received = 0
+        self.merged = 0
+        self.dropped = 0
+        self.drained = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # returns whether the event was kept
+    def put(self, address, event=None):
+        self.received += 1
+        if address in self.entries:
+            self.merged += 1
+        elif len(self.entries) >= self.capacity:
+            if not self.overflowed:
+                _LOGGER.warning("Event buffer full at %d nodes, dropping events until the next full recompute",
+                                self.capacity)
+            self.dropped += 1
+            self.overflowed = True
+            return False
+        self.entries[address] = event
+        return True
+
+    # takes up to batch of the oldest entries, as (address, event) pairs.
+    # the rest stay pending for the next drain
+    def drain(self, batch=BATCH):
+        if len(self.entries) <= batch:
+            drained = list(self.entries.items())
+            self.entries = {}
+        else:
+            drained = [(address, self.entries[address]) for address in itertools.islice(self.entries, batch)]
+            for address, _ in drained:
+                del self.entries[address]
+        self.drained += len(drained)
+        return drained
+
+    # whether an event was dropped since the last call, i.e. every node has to be re-read
+    def take_overflow(self):
+        overflowed = self.overflowed
+        self.overflowed = False
+        return overflowed
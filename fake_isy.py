@@ -0,0 +1,333 @@
+import asyncio
+import time
+
+from pyisy.constants import (
+    CMD_OFF,
+    ES_CONNECTED,
+    ES_LOST_STREAM_CONNECTION,
+    ES_STOP_UPDATES,
+    PROP_HUMIDITY,
+    PROP_STATUS,
+)
+from pyisy.helpers import EventEmitter, NodeProperty
+
+import config
+
+# the control of a script step that sets an isy variable instead of a node
+VARIABLE = "VAR"
+
+
+class FakeNode:
+
+    # stands in for a pyisy node. commands wait for the latency of the fake isy,
+    # and the status follows after its status lag, like the real controller
+    # reporting back over the websocket
+
+    # FIELDS
+    #
+    # isy: the FakeISY the node belongs to
+    # address: the address of the node
+    # name: the english name of the node
+    # aux_properties: the aux properties of the node, e.g. CLIHUM, keyed by control
+    # status_events: notified on every status or aux property change
+
+    # this is the constructor method
+    def __init__(self, isy, address, name, status=0):
+        self.isy = isy
+        self.address = address
+        self.name = name
+        self._status = status
+        self.aux_properties = {}
+        self.status_events = EventEmitter()
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, value):
+        if self._status != value:
+            self._status = value
+            self.status_events.notify(self.status_feedback)
+
+    @property
+    def status_feedback(self):
+        return {"address": self.address, "status": self._status}
+
+    def set_property(self, control, value):
+        prop = self.aux_properties.get(control)
+        if prop is not None and prop.value == value:
+            return
+        self.aux_properties[control] = NodeProperty(control, value, address=self.address)
+        self.status_events.notify(self.status_feedback)
+
+    async def turn_on(self, val=None):
+        return await self.isy.command(self, 255 if val is None else val)
+
+    async def turn_off(self):
+        return await self.isy.command(self, 0)
+
+
+class FakeNodes:
+
+    # FIELDS
+    #
+    # by_address: the nodes keyed by address
+    # by_name: the same nodes keyed by name
+    # status_events: notified on structural node changes, never by the fake itself
+
+    # this is the constructor method
+    def __init__(self):
+        self.by_address = {}
+        self.by_name = {}
+        self.status_events = EventEmitter()
+
+    def add(self, node):
+        self.by_address[node.address] = node
+        self.by_name[node.name] = node
+        return node
+
+    # like pyisy, nodes can be looked up by address or by name
+    def __getitem__(self, key):
+        node = self.by_address.get(key)
+        if node is None:
+            node = self.by_name[key]
+        return node
+
+    def __contains__(self, key):
+        return key in self.by_address or key in self.by_name
+
+    def __iter__(self):
+        return iter(self.by_address.values())
+
+    def __len__(self):
+        return len(self.by_address)
+
+    # the statuses of the fake are always current
+    async def update(self, wait_time=0, xml=None):
+        pass
+
+
+class FakeVariable:
+
+    # FIELDS
+    #
+    # name: the name of the variable
+    # status_events: notified on every status change
+
+    # this is the constructor method
+    def __init__(self, name, status=0):
+        self.name = name
+        self._status = status
+        self.status_events = EventEmitter()
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, value):
+        if self._status != value:
+            self._status = value
+            self.status_events.notify({"name": self.name, "status": value})
+
+
+class FakeVariables:
+
+    # this is the constructor method
+    def __init__(self):
+        self.by_name = {}
+
+    def add(self, name, status=0):
+        self.by_name[name] = FakeVariable(name, status)
+        return self.by_name[name]
+
+    def get_by_name(self, name):
+        return self.by_name.get(name)
+
+    async def update(self, wait_time=0):
+        pass
+
+
+class FakeWebsocket:
+
+    # FIELDS
+    #
+    # isy: the FakeISY whose connection_events the status changes are sent to
+    # status: the pyisy event stream status
+
+    # this is the constructor method
+    def __init__(self, isy):
+        self.isy = isy
+        self.status = ES_CONNECTED
+
+    def set_status(self, status):
+        if self.status != status:
+            self.status = status
+            self.isy.connection_events.notify(status)
+
+    # connects right away unless the fake isy is offline
+    def start(self):
+        if self.isy.online:
+            self.set_status(ES_CONNECTED)
+
+    def stop(self):
+        self.set_status(ES_STOP_UPDATES)
+
+
+class FakeConnection:
+
+    # stands in for isy.conn, the rest api of the isy
+
+    # this is the constructor method
+    def __init__(self, isy):
+        self.isy = isy
+
+    async def get_status(self):
+        return "<nodes />" if self.isy.online else None
+
+    def compile_url(self, path, query=None):
+        return "/rest/" + "/".join(path)
+
+    # only node commands, /rest/nodes/<address>/cmd/<DON or DOF>[/<level>]
+    async def request(self, url, retry404=False):
+        if not self.isy.online:
+            return None
+        path = url.split("/")
+        address, command, level = path[3], path[5], path[6] if len(path) > 6 else None
+        if command == CMD_OFF:
+            level = 0
+        return await self.isy.command(self.isy.nodes[address], 255 if level is None else int(level))
+
+
+class FakeISY:
+
+    # an in-process stand-in for the subset of pyisy.ISY that main.py, fan.py and
+    # humidity.py use, for running and benchmarking the control logic without a controller
+
+    # FIELDS
+    #
+    # nodes: the FakeNodes
+    # variables: the FakeVariables
+    # status_events: the system status events, never notified by the fake
+    # connection_events: the connection events, notified by the websocket
+    # websocket: a websocket that only tracks its status
+    # conn: the rest api, only for reading the statuses
+    # online: whether the fake isy can be reached, see disconnect and reconnect
+    # latency: seconds every command takes, or a function returning them
+    # status_lag: seconds between a command finishing and the node status changing
+    # commands: every command sent, as (monotonic time, address, level)
+
+    # this is the constructor method
+    def __init__(self, latency=0, status_lag=0):
+        self.nodes = FakeNodes()
+        self.variables = FakeVariables()
+        self.status_events = EventEmitter()
+        self.connection_events = EventEmitter()
+        self.online = True
+        self.websocket = FakeWebsocket(self)
+        self.conn = FakeConnection(self)
+        self.latency = latency
+        self.status_lag = status_lag
+        self.commands = []
+
+    async def initialize(self, node_servers=False):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    # drops the websocket like a network hiccup. it stays down until reconnect
+    def disconnect(self):
+        self.online = False
+        self.websocket.set_status(ES_LOST_STREAM_CONNECTION)
+
+    # lets the websocket be started again
+    def reconnect(self):
+        self.online = True
+
+    def add_node(self, address, name=None, status=0):
+        return self.nodes.add(FakeNode(self, address, name or address, status))
+
+    async def command(self, node, level):
+        self.commands.append((time.monotonic(), node.address, level))
+
+        latency = self.latency() if callable(self.latency) else self.latency
+        if latency:
+            await asyncio.sleep(latency)
+
+        if self.status_lag:
+            asyncio.get_running_loop().call_later(self.status_lag, setattr, node, "status", level)
+        else:
+            node.status = level
+        return True
+
+    # applies one step of a script: a node status, an aux property or a variable
+    def apply(self, target, control, value):
+        if control == VARIABLE:
+            self.variables.get_by_name(target).status = value
+        elif control == PROP_STATUS:
+            self.nodes[target].status = value
+        else:
+            self.nodes[target].set_property(control, value)
+
+    # plays a scripted event stream of (seconds from start, target, control, value).
+    # speed scales the waits between steps, 0 plays the steps as fast as possible
+    async def play(self, script, speed=1):
+        start = time.monotonic()
+        for at, target, control, value in script:
+            if speed:
+                delay = start + at / speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                # still let the controller see every step
+                await asyncio.sleep(0)
+            self.apply(target, control, value)
+
+    # builds a fake isy with a node for every fan and sensor of the registry
+    @classmethod
+    def from_registry(cls, registry, iaq_on=1, humidity=40, **kwargs):
+        isy = cls(**kwargs)
+        for spec in registry.exhaust_fans + registry.supplies:
+            isy.add_node(spec.node_name, spec.name)
+        for room in registry.rooms:
+            if room.sens_hum not in isy.nodes:
+                isy.add_node(room.sens_hum).set_property(PROP_HUMIDITY, humidity)
+            if room.sens_motion not in isy.nodes:
+                isy.add_node(room.sens_motion)
+            if room.fan not in isy.nodes:
+                isy.add_node(room.fan)
+        isy.variables.add("IAQ_on_off", iaq_on)
+        return isy
+
+
+# builds a registry with the damper and fresh air fans plus the given number of
+# exhaust fans and rooms. every room gets its own sensors and one of the exhaust fans
+def synthetic_registry(fans, rooms=0):
+    exhaust_fans = [config.FanSpec("n001_zone_38", "VentaHood L1", 200, "bool", "exhaust")]
+    for i in range(1, max(fans, rooms + 1)):
+        if i % 2:
+            exhaust_fans.append(config.FanSpec("exhaust_{}".format(i), "Exhaust Fan {}".format(i), 418, 255, "exhaust"))
+        else:
+            exhaust_fans.append(config.FanSpec("exhaust_{}".format(i), "Exhaust Fan {}".format(i), 100, "bool", "exhaust"))
+
+    supplies = (
+        config.FanSpec("n001_output_33", "Fresh Air", 200, "bool", "supply", config.DAMPER, priority=1, travel=33),
+        config.FanSpec("53 23 84 1", "Fresh Air Fan - 12 inch", 940, 255, "supply", config.FRESH_AIR_FAN_12_INCH,
+                       priority=3, first_when=(("n001_zone_38", 2),)),
+        config.FanSpec("53 25 DA 1", "Fresh Air Fan - 8 inch", 461, 255, "supply", config.FRESH_AIR_FAN_8_INCH,
+                       priority=2, after_damper=True),
+    )
+
+    room_specs = []
+    for i in range(rooms):
+        room_specs.append(config.RoomSpec(sens_hum="humidity_{}".format(i),
+                                          sens_motion="motion_{}".format(i),
+                                          fan=exhaust_fans[i + 1].node_name,
+                                          hum=60,
+                                          hum_t=900,
+                                          motion_power=77,
+                                          motion_t=900))
+
+    return config.Registry(tuple(exhaust_fans), supplies, tuple(room_specs))
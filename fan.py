@@ -1,30 +1,78 @@
-import json
 import time
+
+from cfm import CFMAccumulator, fan_cfm
 from color import color
+from curve import fan_curve
 
 
 class Fan:
 
     # FIELDS
     # 
+    # spec: the config.FanSpec of the fan
     # node: the isy node object
     # name: the english name of the node
     # value: the status of the isy.node
     # cfm: the cfm of the fan
     # type: # whether the fan status is binary or a scale
-    # time_off: time since the fan was last turned off. 
-    #           this is used for knowing when the freshair damper is open
+    # time_off: the wall clock time the fan was last turned off. only shown,
+    #           the fresh air damper is followed by damper.Damper
+    # ratio: 1 / type for fans with a scale, so it is not recomputed for every sum
+    # curve: the curve.FanCurve of a fan with a measured curve, None for linear fans
+    # accumulator: the CFMAccumulator this fan reports its cfm changes to
+    # contribution: the cfm this fan currently adds to the accumulator
 
-    # this is the constructor method
-    def __init__(self, isy, node_name: str):
-        with open("util.json", "r") as file:
-            file_data = json.load(file)
+    # whether the fan counts towards the exhaust or the supply total
+    kind = None
 
-        self.node = isy.nodes[node_name]
+    # this is the constructor method
+    def __init__(self, isy, spec):
+        self.node = isy.nodes[spec.node_name]
         self.name = self.node.name
+        self.set_spec(spec)
+        self.accumulator = None
+        self.contribution = 0
         self.value = self.node.status
         self.time_off = 0
 
+    @property
+    def value(self):
+        return self._value
+
+    # every change of the value is passed on to the accumulator as a cfm delta
+    @value.setter
+    def value(self, value):
+        self._value = value
+        if self.accumulator is not None:
+            contribution = fan_cfm(self, value)
+            self.accumulator.add(self.kind, contribution - self.contribution)
+            self.contribution = contribution
+
+    # takes the cfm and type from the spec, e.g. when util.json was edited
+    def set_spec(self, spec):
+        self.spec = spec
+        self.cfm = spec.cfm
+        self.type = spec.type
+        self.ratio = 1 / self.type if type(self.type) == int else None
+        self.curve = fan_curve(spec.curve, spec.type) if spec.curve else None
+
+        # the cfm of the fan at its current value has changed as well
+        if getattr(self, "accumulator", None) is not None:
+            self.value = self._value
+
+    # starts reporting the cfm of this fan to the accumulator
+    def attach(self, accumulator):
+        self.accumulator = accumulator
+        self.contribution = fan_cfm(self, self._value)
+        accumulator.add(self.kind, self.contribution)
+
+    # stops reporting the cfm of this fan and takes it out of the accumulator
+    def detach(self):
+        if self.accumulator is not None:
+            self.accumulator.add(self.kind, -self.contribution)
+        self.accumulator = None
+        self.contribution = 0
+
     def update(self):
         old_value = self.value
         self.value = self.node.status
@@ -35,12 +83,8 @@ class Fan:
 
     # this provides formatted console output
     def __str__(self):
-        string = ""
-        string += "Name: {}{}{}\n".format(color.UNDERLINE, self.name, color.END)
-        string += "Value: {}\n".format(self.value)
-        string += "CFM: {}\n".format(self.cfm)
-        string += "Type: {}\n".format(self.type)
-        return string
+        return "Name: {}{}{}\nValue: {}\nCFM: {}\nType: {}\n".format(
+            color.UNDERLINE, self.name, color.END, self.value, self.cfm, self.type)
 
 
 class ExhaustFan(Fan):
@@ -57,22 +101,11 @@ class ExhaustFan(Fan):
     # type: # whether the fan status is binary or a scale
     #
 
-    # this is the constructor method
-    def __init__(self, isy, node_name: str):
-        with open("util.json", "r") as file:
-            file_data = json.load(file)
-        super().__init__(isy, node_name)
-        self.cfm = file_data["exhaust_fans"][node_name].get("cfm")
-        self.type = file_data["exhaust_fans"][node_name].get("type")
+    kind = "exhaust"
 
     def __str__(self):
-        string = ""
-        string += "Name: {}{}{}\n".format(color.UNDERLINE, self.name, color.END)
-        string += "Value: {}\n".format(self.value)
-        string += "Time since last off: {}\n".format(self.time_off)
-        string += "CFM: {}\n".format(self.cfm)
-        string += "Type: {}\n".format(self.type)
-        return string
+        return "Name: {}{}{}\nValue: {}\nTime since last off: {}\nCFM: {}\nType: {}\n".format(
+            color.UNDERLINE, self.name, color.END, self.value, self.time_off, self.cfm, self.type)
 
 
 class SupplyFan(Fan):
@@ -89,39 +122,86 @@ class SupplyFan(Fan):
     # type: # whether the fan status is binary or a scale
     #
 
-    # this is the constructor method
-    def __init__(self, isy, node_name):
-        with open("util.json", "r") as file:
-            file_data = json.load(file)
-        super().__init__(isy, node_name)
-        self.cfm = file_data["supplies"][node_name].get("cfm")
-        self.type = file_data["supplies"][node_name].get("type")
+    kind = "supply"
 
 
 class FansDict:
     # FIELDS
     #
+    # isy: the isy object
     # dict: a dictionary of the fans
+    # by_address: the same fans keyed by the address of their isy node
+    # by_role: the fans that have a role in util.json, keyed by role
+    # accumulator: the CFMAccumulator that keeps the cfm total of the fans,
+    #              or a fantable.FanTable that also holds their state
 
-    # updates the state of the fans
-    def update(self):
-        for fan in self.dict:
-            self.dict[fan].update()
+    # the class of the fans in the dict
+    fan_class = Fan
+
+    # this is the constructor method
+    # specs: the config.FanSpecs of the fans
+    def __init__(self, isy, specs, accumulator=None):
+        self.isy = isy
+        self.dict = {}
+        self.by_address = {}
+        self.by_role = {}
+        self.accumulator = accumulator or CFMAccumulator()
+        self.apply(specs)
+
+    # brings the fans in line with the specs. fans that are still there keep their
+    # state and only get their new cfm and type, new fans are added and
+    # fans that are no longer in the specs are removed.
+    # returns the node names of the fans that were added, changed and removed
+    def apply(self, specs):
+        added, changed = [], []
+        fans = {}
+        for spec in specs:
+            fan = self.dict.get(spec.node_name)
+            if fan is None:
+                fan = self.accumulator.add_fan(self, spec)
+                added.append(spec.node_name)
+            elif fan.spec != spec:
+                fan.set_spec(spec)
+                changed.append(spec.node_name)
+            fans[spec.node_name] = fan
+
+        removed = [node_name for node_name in self.dict if node_name not in fans]
+        for node_name in removed:
+            self.dict[node_name].detach()
+
+        self.dict = fans
+        self.by_address = {fan.node.address: fan for fan in fans.values()}
+        self.by_role = {fan.spec.role: fan for fan in fans.values() if fan.spec.role is not None}
+        return added, changed, removed
+
+    # moves the fans over to the nodes of another isy with the same nodes,
+    # e.g. from a snapshot.WarmISY to the initialized pyisy.ISY, and takes their statuses
+    def rebind(self, isy):
+        self.isy = isy
+        for node_name, fan in self.dict.items():
+            fan.node = isy.nodes[node_name]
+            fan.update()
+        self.by_address = {fan.node.address: fan for fan in self.dict.values()}
+
+    # updates the state of the fans.
+    # if addresses is given only the fans with those node addresses are updated
+    def update(self, addresses=None):
+        if addresses is None:
+            for fan in self.dict:
+                self.dict[fan].update()
+            return
+
+        for address in addresses:
+            fan = self.by_address.get(address)
+            if fan is not None:
+                fan.update()
 
 
 class ExhaustFans(FansDict):
 
-    # this is the constructor method
-    def __init__(self, isy, node_names):
-        self.dict = {}
-        for node_name in node_names:
-            self.dict[node_name] = ExhaustFan(isy, node_name)
+    fan_class = ExhaustFan
 
 
 class SupplyFans(FansDict):
 
-    # this is the constructor method
-    def __init__(self, isy, supply_node_names):
-        self.dict = {}
-        for supply in supply_node_names:
-            self.dict[supply] = SupplyFan(isy, supply)
+    fan_class = SupplyFan
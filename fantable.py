@@ -0,0 +1,232 @@
+from array import array
+
+from curve import fan_curve
+from fan import Fan
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+EXHAUST = 0
+SUPPLY = 1
+# the index of the VentaHood exhaust in FanTable.totals
+VENTAHOOD = 2
+
+
+class TableFan:
+
+    # a fan whose state lives in a FanTable. it has the same fields and methods
+    # as fan.Fan, but value, cfm, type and time_off are read from and written
+    # to the columns of the table
+
+    # FIELDS
+    #
+    # table: the FanTable holding the state
+    # index: the row of the fan in the table
+    # spec: the config.FanSpec of the fan
+    # node: the isy node object
+    # name: the english name of the node
+
+    __slots__ = ("table", "index", "spec", "node", "name")
+
+    # this is the constructor method
+    def __init__(self, table, index, spec, node):
+        self.table = table
+        self.index = index
+        self.spec = spec
+        self.node = node
+        self.name = node.name
+
+    @property
+    def kind(self):
+        return "exhaust" if self.table.kind[self.index] == EXHAUST else "supply"
+
+    # the level column holds floats for numpy, the value is the int status like fan.Fan
+    @property
+    def value(self):
+        return int(self.table.level[self.index])
+
+    @value.setter
+    def value(self, value):
+        self.table.set_level(self.index, value)
+
+    @property
+    def time_off(self):
+        return self.table.time_off[self.index]
+
+    @time_off.setter
+    def time_off(self, value):
+        self.table.time_off[self.index] = value
+
+    @property
+    def cfm(self):
+        return self.spec.cfm
+
+    @property
+    def type(self):
+        return self.spec.type
+
+    @property
+    def ratio(self):
+        return self.table.ratio[self.index] or None
+
+    @property
+    def curve(self):
+        return self.table.curves.get(self.index)
+
+    def set_spec(self, spec):
+        self.spec = spec
+        self.table.set_spec(self.index, spec)
+
+    def detach(self):
+        self.table.remove(self.index)
+
+    update = Fan.update
+    __str__ = Fan.__str__
+
+
+class FanTable:
+
+    # keeps the state of all exhaust and supply fans in contiguous columns, one row
+    # per fan. it takes the place of the cfm.CFMAccumulator: the totals are read
+    # from exhaust, supply and net, and the exhaust split into the VentaHood and
+    # all other exhaust fans from exhaust_by_category. a change of one value adjusts
+    # the totals by the change of that fan's cfm, so it costs the same however many fans there are.
+    # after rows were added, removed or given a new spec (loading or reloading
+    # util.json) the totals are recomputed from the columns at once, as vectors
+    # with numpy installed, otherwise in one plain loop
+
+    # FIELDS
+    #
+    # cfm: the cfm of every fan
+    # ratio: 1 / type of every fan with a scale, 0 for on/off fans
+    # level: the current value of every fan
+    # time_off: the time_off of every fan
+    # kind: EXHAUST or SUPPLY for every fan
+    # ventahood: 1 for the VentaHood exhaust fans, 0 otherwise
+    # curves: the curve.FanCurve of the fans with a measured curve, keyed by row.
+    #         their cfm and ratio are 0 and their cfm is added after the columns
+    # free: rows of removed fans that can be reused
+    # stale: whether rows changed since the totals were recomputed from the columns
+    # totals: the [exhaust, supply, VentaHood exhaust] cfm
+
+    # this is the constructor method
+    def __init__(self):
+        self.cfm = array("d")
+        self.ratio = array("d")
+        self.level = array("d")
+        self.time_off = array("d")
+        self.kind = array("b")
+        self.ventahood = array("b")
+        self.curves = {}
+        self.free = []
+        self.stale = False
+        self.totals = [0, 0, 0]
+
+    # creates a fan for the spec with its state in a row of the table
+    # fans_object: the FansDict the fan is for
+    def add_fan(self, fans_object, spec):
+        node = fans_object.isy.nodes[spec.node_name]
+        if self.free:
+            index = self.free.pop()
+        else:
+            index = len(self.cfm)
+            for column in (self.cfm, self.ratio, self.level, self.time_off, self.kind, self.ventahood):
+                column.append(0)
+
+        self.kind[index] = EXHAUST if fans_object.fan_class.kind == "exhaust" else SUPPLY
+        self.level[index] = node.status
+        self.time_off[index] = 0
+        self.set_spec(index, spec)
+        return TableFan(self, index, spec, node)
+
+    def set_spec(self, index, spec):
+        self.ventahood[index] = self.kind[index] == EXHAUST and "ventahood" in spec.name.lower()
+        if spec.curve:
+            self.curves[index] = fan_curve(spec.curve, spec.type)
+            self.cfm[index] = 0
+            self.ratio[index] = 0
+        else:
+            self.curves.pop(index, None)
+            self.cfm[index] = spec.cfm
+            self.ratio[index] = 1 / spec.type if type(spec.type) == int else 0
+        self.stale = True
+
+    # the row keeps existing but no longer adds anything to the totals
+    def remove(self, index):
+        self.cfm[index] = 0
+        self.level[index] = 0
+        self.ventahood[index] = 0
+        self.curves.pop(index, None)
+        self.free.append(index)
+        self.stale = True
+
+    # the cfm of the fan in the row at the level, same rounding as cfm.fan_cfm
+    def row_cfm(self, index, level):
+        curve = self.curves.get(index)
+        if curve is not None:
+            return curve.cfm(level)
+        cfm = self.cfm[index]
+        ratio = self.ratio[index]
+        return round(cfm * level * ratio) if ratio else (int(cfm) if level else 0)
+
+    def set_level(self, index, level):
+        if not self.stale:
+            delta = self.row_cfm(index, level) - self.row_cfm(index, self.level[index])
+            self.totals[self.kind[index]] += delta
+            if self.ventahood[index]:
+                self.totals[VENTAHOOD] += delta
+        self.level[index] = level
+
+    def compute(self):
+        if numpy is not None:
+            cfm = numpy.frombuffer(self.cfm)
+            ratio = numpy.frombuffer(self.ratio)
+            level = numpy.frombuffer(self.level)
+            kind = numpy.frombuffer(self.kind, dtype=numpy.int8)
+            ventahood = numpy.frombuffer(self.ventahood, dtype=numpy.int8)
+
+            # same order of operations as cfm.fan_cfm so the rounding matches
+            fan_cfm = numpy.where(ratio > 0, numpy.round(cfm * level * ratio), numpy.where(level != 0, cfm, 0))
+            totals = [int(fan_cfm[kind == EXHAUST].sum()), int(fan_cfm[kind == SUPPLY].sum()),
+                      int(fan_cfm[ventahood == 1].sum())]
+        else:
+            totals = [0, 0, 0]
+            for cfm, ratio, level, kind, ventahood in zip(self.cfm, self.ratio, self.level, self.kind,
+                                                          self.ventahood):
+                fan_cfm = round(cfm * level * ratio) if ratio else (int(cfm) if level else 0)
+                totals[kind] += fan_cfm
+                if ventahood:
+                    totals[VENTAHOOD] += fan_cfm
+
+        for index, curve in self.curves.items():
+            fan_cfm = curve.cfm(self.level[index])
+            totals[self.kind[index]] += fan_cfm
+            if self.ventahood[index]:
+                totals[VENTAHOOD] += fan_cfm
+        return totals
+
+    def get_totals(self):
+        if self.stale:
+            self.totals = self.compute()
+            self.stale = False
+        return self.totals
+
+    @property
+    def exhaust(self):
+        return self.get_totals()[0]
+
+    @property
+    def supply(self):
+        return self.get_totals()[1]
+
+    @property
+    def net(self):
+        exhaust, supply, _ = self.get_totals()
+        return exhaust - supply
+
+    # the exhaust cfm split into the VentaHood and all other exhaust fans
+    def exhaust_by_category(self):
+        exhaust, _, ventahood = self.get_totals()
+        return {"ventahood": ventahood, "other": exhaust - ventahood}
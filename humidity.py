@@ -1,11 +1,30 @@
-import json
-import time
+import asyncio
+import math
+
+from actuator import Actuator
+
+# the smoothed humidity is taken as on a threshold this close to it, so a
+# timer set for the crossing does not miss it by a rounding error
+EPSILON = 1e-6
+# a rise of the humidity only holds the fan once the reading is within this
+# many percent of "hum", so the air drying out and recovering (e.g. 30% to 32%
+# on a winter morning) does not
+RISE_WINDOW = 10
 
 
 def get_hum(self):
     return self.aux_properties["CLIHUM"].value
 
 
+# the humidity of the sensor, None while it has not reported one yet.
+# for the status page and telemetry, which must not fail on a new sensor
+def reported_hum(self):
+    try:
+        return get_hum(self)
+    except KeyError:
+        return None
+
+
 def get_motion(self):
     # match self.status:
     #     case 0:
@@ -24,61 +43,259 @@ class Room:
     # sens_hum: the humidity sensor
     # sens_motion: the motion sensor
     # fan: the fan that should turn on
-    # hum: the humidity value that the fan should turn on at
-    # hum_last_time: the last time the humidity was above "hum"
+    # hum: the humidity value that the fan should turn on at, or the name of the isy variable holding it
+    # hum_until: the monotonic time the fan stays at full speed until, because the humidity was above "hum"
     # hum_t: the time the fan should be on for after humidity is too high
     # motion_power: the power the fan should be set to when motion is detected
-    # motion_last_time: the last time motion was detected
+    # motion_until: the monotonic time the fan stays on until, because motion was detected
     # motion_t: the time the fan should be on after motion detected
+    # hum_band: once humid, the room stays humid until the smoothed humidity is this far below "hum"
+    # hum_smooth: the time constant in seconds of the moving average of the humidity, 0 for none
+    # hum_rise: a reading within RISE_WINDOW of "hum" that pulls the moving average up by
+    #           this many percent per minute (e.g. a shower starting) holds the fan on right
+    #           away, 0 for never. without smoothing the rise between two readings is used
+    # humid: whether the reading or the smoothed humidity reached "hum", within hum_band once it was
+    # reading: the last humidity the sensor reported
+    # read_at: the monotonic time of that reading, None before the first one
+    # smoothed: the moving average of the humidity at read_at
+    #
+    # the moving average is exponential over time and only changes when a
+    # reading arrives, so it is worked out in O(1) for any time from the last
+    # reading alone, however irregular the readings and ticks are
 
-    def __init__(self, isy, sens_hum, sens_motion, fan, hum, hum_t, motion_power, motion_t):
+    def __init__(self, isy, sens_hum, sens_motion, fan, hum, hum_t, motion_power, motion_t,
+                 hum_band=0, hum_smooth=0, hum_rise=0):
         self.sens_hum = isy.nodes[sens_hum]
         self.sens_motion = isy.nodes[sens_motion]
         self.fan = isy.nodes[fan]
         self.hum = hum
-        self.hum_last_time = 0
+        self.hum_until = 0
         self.hum_t = hum_t
         self.motion_power = motion_power
-        self.motion_last_time = 0
+        self.motion_until = 0
         self.motion_t = motion_t
+        self.hum_band = hum_band
+        self.hum_smooth = hum_smooth
+        self.hum_rise = hum_rise
+        self.humid = False
+        self.reading = None
+        self.read_at = None
+        self.smoothed = None
+
+    # takes the reading of the sensor at the monotonic time now.
+    # returns whether the humidity rises faster than hum_rise
+    def sample(self, reading, now):
+        if self.read_at is None:
+            self.reading = self.smoothed = reading
+            self.read_at = now
+            return False
+        if reading == self.reading:
+            return False
+
+        smoothed = self.smoothed_at(now)
+        if self.hum_smooth:
+            # how fast the average starts moving towards the new reading,
+            # which stays small for a sensor going back and forth around it
+            rise = (reading - smoothed) * 60 / self.hum_smooth
+        else:
+            elapsed = now - self.read_at
+            rise = (reading - self.reading) * 60 / elapsed if elapsed > 0 else 0
+        self.smoothed = smoothed
+        self.reading = reading
+        self.read_at = now
+        return bool(self.hum_rise) and rise >= self.hum_rise
+
+    # the moving average at the monotonic time now, with the last reading held since it arrived
+    def smoothed_at(self, now):
+        if not self.hum_smooth:
+            return self.reading
+        return self.reading + (self.smoothed - self.reading) * math.exp((self.read_at - now) / self.hum_smooth)
+
+    # the monotonic time the moving average reaches threshold if no other reading
+    # arrives, None if it is not heading there
+    def crossing(self, now, threshold):
+        if not self.hum_smooth:
+            return None
+        smoothed = self.smoothed_at(now)
+        if (smoothed - threshold) * (self.reading - threshold) >= 0:
+            return None
+        return now + self.hum_smooth * math.log((self.reading - smoothed) / (self.reading - threshold))
 
 
 class Humidity:
     # FIELDS
+    # isy: the isy object
+    # actuator: the Actuator the fan commands are sent through
+    # variables: the variables.Variables the humidity setpoints held in isy variables are read from
     # rooms: a set of room objects
-    def __init__(self, isy, json_dict):
-        # def __init__(self, json_dict):
-        rooms = set()
-
-        for room in json_dict["honeywell_sens"]:
-            rooms.add(Room(isy=isy,
-                           sens_hum=room["sens_hum"],
-                           sens_motion=room["sens_motion"],
-                           fan=room["fan"],
-                           hum=room["hum"],
-                           hum_t=room["hum_t"],
-                           motion_power=room["motion_power"],
-                           motion_t=room["motion_t"]))
-        self.rooms = rooms
-
-    async def check_humidity(self):
+    # by_key: the same rooms keyed by the names of their sensors and fan
+    # by_address: the rooms that use each sensor node, keyed by node address
+    # timers: the asyncio timer of every room whose fan is being held on, keyed by room
+    # on_expire: called with the room when its timer fires. if it is not set the
+    #            room is checked right away by the timer itself
+
+    # this is the constructor method
+    # registry: the config.Registry the rooms are read from
+    def __init__(self, isy, registry, actuator=None, variables=None):
+        self.isy = isy
+        self.actuator = actuator or Actuator()
+        self.variables = variables
+        self.rooms = set()
+        self.by_key = {}
+        self.by_address = {}
+        self.timers = {}
+        self.on_expire = None
+        self.apply(registry)
+
+    # brings the rooms in line with the registry. rooms that are still there keep
+    # their hold times and only get their new thresholds.
+    # returns the number of rooms that were added, changed and removed
+    def apply(self, registry):
+        added = changed = 0
+        by_key = {}
+        for spec in registry.rooms:
+            key = (spec.sens_hum, spec.sens_motion, spec.fan)
+            room = self.by_key.get(key)
+            if room is None:
+                room = Room(isy=self.isy,
+                            sens_hum=spec.sens_hum,
+                            sens_motion=spec.sens_motion,
+                            fan=spec.fan,
+                            hum=spec.hum,
+                            hum_t=spec.hum_t,
+                            motion_power=spec.motion_power,
+                            motion_t=spec.motion_t,
+                            hum_band=spec.hum_band,
+                            hum_smooth=spec.hum_smooth,
+                            hum_rise=spec.hum_rise)
+                added += 1
+            elif (room.hum, room.hum_t, room.motion_power, room.motion_t,
+                  room.hum_band, room.hum_smooth, room.hum_rise) != \
+                    (spec.hum, spec.hum_t, spec.motion_power, spec.motion_t,
+                     spec.hum_band, spec.hum_smooth, spec.hum_rise):
+                room.hum = spec.hum
+                room.hum_t = spec.hum_t
+                room.motion_power = spec.motion_power
+                room.motion_t = spec.motion_t
+                room.hum_band = spec.hum_band
+                room.hum_smooth = spec.hum_smooth
+                room.hum_rise = spec.hum_rise
+                changed += 1
+            by_key[key] = room
+
+        removed = 0
+        for key, room in self.by_key.items():
+            if key not in by_key:
+                self.disarm(room)
+                removed += 1
+
+        self.by_key = by_key
+        self.rooms = set(by_key.values())
+        self.index()
+        return added, changed, removed
+
+    # moves the rooms over to the nodes of another isy with the same nodes,
+    # e.g. from a snapshot.WarmISY to the initialized pyisy.ISY. the hold times are kept
+    def rebind(self, isy):
+        self.isy = isy
+        for (sens_hum, sens_motion, fan), room in self.by_key.items():
+            room.sens_hum = isy.nodes[sens_hum]
+            room.sens_motion = isy.nodes[sens_motion]
+            room.fan = isy.nodes[fan]
+        self.index()
+
+    def index(self):
+        self.by_address = {}
         for room in self.rooms:
+            for node in (room.sens_hum, room.sens_motion):
+                self.by_address.setdefault(node.address, set()).add(room)
+
+    # sets the timer of the room to fire at the monotonic time expiry, or clears it
+    def arm(self, room, expiry, loop):
+        timer = self.timers.get(room)
+        if timer is not None:
+            if timer.when() == expiry:
+                return
+            timer.cancel()
 
-            if get_motion(room.sens_motion):
-                room.motion_last_time = time.time()
+        if expiry is None:
+            self.timers.pop(room, None)
+        else:
+            self.timers[room] = loop.call_at(expiry, self.expire, room)
 
-            # if the humidity is too high
-            if get_hum(room.sens_hum) >= room.hum:
-                room.hum_last_time = time.time()
+    def disarm(self, room):
+        timer = self.timers.pop(room, None)
+        if timer is not None:
+            timer.cancel()
 
-            if time.time() - room.hum_last_time < room.hum_t:
-                if room.fan.status != 255:
-                    await room.fan.turn_on(255)
+    # a hold time of the room ran out, so its fan has to be turned down or off
+    def expire(self, room):
+        self.timers.pop(room, None)
+        if self.on_expire is not None:
+            self.on_expire(room)
+        else:
+            asyncio.ensure_future(self.check_humidity({room}))
 
-            elif time.time() - room.motion_last_time < room.motion_t:
-                if room.fan.status != int(room.motion_power):
-                    await room.fan.turn_on(int(room.motion_power))
+    # decides the fan level of the room and arms its timer for the next change.
+    # now is the monotonic time of the loop, values the isy variables of the tick
+    def evaluate(self, room, now, loop, values):
+        if get_motion(room.sens_motion):
+            room.motion_until = now + room.motion_t
 
+        hum = values.get(room.hum) if isinstance(room.hum, str) else room.hum
+        rose = room.sample(get_hum(room.sens_hum), now) and hum is not None and room.reading >= hum - RISE_WINDOW
+
+        # if the humidity is too high. a reading at hum makes the room humid
+        # right away, the average only lags behind it. the room stays humid
+        # until the reading is below hum and the average is hum_band below it,
+        # and is held for hum_t after that
+        crossing = None
+        was_humid = room.humid
+        if hum is None:
+            room.humid = False
+        else:
+            smoothed = room.smoothed_at(now)
+            if room.reading >= hum:
+                room.humid = True
+            elif was_humid:
+                room.humid = smoothed > hum - room.hum_band + EPSILON
             else:
-                if room.fan.status != 0:
-                    await room.fan.turn_off()
+                room.humid = smoothed >= hum - EPSILON
+            # the average may get back under the band before the next reading.
+            # while not humid the reading is below hum, so the average cannot get over it
+            if room.humid and room.reading < hum and room.hum_smooth:
+                crossing = room.crossing(now, hum - room.hum_band)
+        if room.humid or was_humid or rose:
+            room.hum_until = now + room.hum_t
+
+        if now < room.hum_until:
+            self.actuator.turn_on(room.fan, 255)
+            expiry = room.hum_until
+
+        elif now < room.motion_until:
+            self.actuator.turn_on(room.fan, int(room.motion_power))
+            expiry = room.motion_until
+
+        else:
+            self.actuator.turn_off(room.fan)
+            expiry = None
+
+        if crossing is not None and (expiry is None or crossing < expiry):
+            expiry = crossing
+        self.arm(room, expiry, loop)
+
+    # if rooms is given only those rooms are checked.
+    # values: the isy variables the tick started with, see variables.Variables
+    async def check_humidity(self, rooms=None, values=None):
+        if rooms is None:
+            rooms = self.rooms
+        if values is None:
+            values = self.variables.values if self.variables is not None else {}
+
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        for room in rooms:
+            self.evaluate(room, now, loop, values)
+
+        # the fans of all the rooms are commanded at the same time
+        await self.actuator.flush()
@@ -1,7 +1,8 @@
+import argparse
 import asyncio
-import json
 import logging
 import os
+import signal
 import time
 from urllib.parse import urlparse
 
@@ -12,10 +13,26 @@ from pyisy.constants import NODE_CHANGED_ACTIONS
 from pyisy.logging import enable_logging
 from pyisy.nodes import NodeChangedEvent
 
+import config
+import connection
 import humidity
+import profiling
+import reload
+import replay
+import report
+import server
+import snapshot
+import telemetry
 from color import color
 # local files
+from actuator import URGENT, Actuator
+from cfm import CFMAccumulator
+from damper import Damper
+from events import EventBuffer
 from fan import ExhaustFans, SupplyFans
+from fantable import FanTable
+from planner import SupplyPlanner
+from variables import Variables
 import AQITracker
 
 load_dotenv()
@@ -24,10 +41,444 @@ ADDRESS = os.getenv("ADDRESS")
 USERNAME = os.getenv("USER_NAME")
 PASSWORD = os.getenv("PASSWORD")
 
+# when set, the control loop only recomputes on node/variable change events
+# (plus a slow safety sweep) instead of on a fixed 1 second tick
+EVENT_DRIVEN = os.getenv("EVENT_DRIVEN", "0") == "1"
+
+# this is the period for the clock cycle of the program in polling mode
+PERIOD = 1
+# the longest the event driven loop goes without a full re-read of every fan and room
+SWEEP_PERIOD = float(os.getenv("SWEEP_PERIOD", "30"))
+
+IAQ_VARIABLE = "IAQ_on_off"
+
+# optional file the validated util.json is cached in between restarts
+CONFIG_CACHE = os.getenv("CONFIG_CACHE")
+# seconds between checks of util.json for edits, 0 turns reloading off
+RELOAD_INTERVAL = float(os.getenv("RELOAD_INTERVAL", "5"))
+
+# keep the state of all fans in one FanTable and sum their cfm as vectors
+COMPACT_FANS = os.getenv("COMPACT_FANS", "0") == "1"
+# the sqlite file the history of the airflow and humidity is kept in, none if not set
+TELEMETRY_DB = os.getenv("TELEMETRY_DB")
+# "json" writes a json line when the state changes, "human" the verbose dump on every tick
+REPORT_MODE = os.getenv("REPORT_MODE", report.JSON)
+# seconds after which the json report is written even if nothing changed
+REPORT_INTERVAL = float(os.getenv("REPORT_INTERVAL", "60"))
+# the file the nodes and variables in use are kept in between restarts. if it
+# exists, control starts from it right away while the isy is initialized in the background
+WARM_START = os.getenv("WARM_START")
+# seconds after which the snapshot is too old to start from, e.g. after a long outage
+WARM_START_MAX_AGE = float(os.getenv("WARM_START_MAX_AGE", "600"))
+# the file every node and variable change and every command is appended to, for replay.py
+RECORD_PATH = os.getenv("RECORD_PATH")
+# the file the sampling profiler writes to when it is stopped by SIGUSR1 or at exit
+PROFILE_PATH = os.getenv("PROFILE_PATH", "profile.txt")
+# the port the status page and metrics are served on, 0 turns the server off
+HTTP_PORT = int(os.getenv("HTTP_PORT", "4002"))
+# seconds between refreshes of the aqi from AirNow
+AQI_TTL = float(os.getenv("AQI_TTL", "600"))
+# seconds a command is not repeated while the node status catches up to it
+COMMAND_DEBOUNCE = float(os.getenv("COMMAND_DEBOUNCE", "2"))
+# the number of commands sent to the isy at the same time, the seconds one
+# attempt may take and the seconds a command is retried for before it is given up
+COMMAND_CONCURRENCY = int(os.getenv("COMMAND_CONCURRENCY", "4"))
+COMMAND_TIMEOUT = float(os.getenv("COMMAND_TIMEOUT", "5"))
+COMMAND_DEADLINE = float(os.getenv("COMMAND_DEADLINE", "30"))
+# seconds waited before the first and at most between attempts to reconnect to the isy
+RECONNECT_MIN = float(os.getenv("RECONNECT_MIN", "1"))
+RECONNECT_MAX = float(os.getenv("RECONNECT_MAX", "120"))
+# the most nodes the event buffer holds changes for, and the most changes one tick takes from it
+EVENT_CAPACITY = int(os.getenv("EVENT_CAPACITY", "1024"))
+EVENT_BATCH = int(os.getenv("EVENT_BATCH", "256"))
+# the exhaust cfm is rounded up to a multiple of this for the supply plans
+PLAN_QUANTUM = float(os.getenv("PLAN_QUANTUM", "5"))
+
 _LOGGER = logging.getLogger(__name__)
 
 
-async def main(url, username, password, tls_ver, events, node_servers):
+class Controller:
+    # FIELDS
+    #
+    # isy: the isy object
+    # exhaust_fans_object: the ExhaustFans object
+    # supply_fans_object: the SupplyFans object
+    # accumulator: the CFMAccumulator (or FanTable) shared by the exhaust and supply fans
+    # humidity_controller: the Humidity object
+    # actuator: the Actuator every node command goes through
+    # variables: the Variables the IAQ_on_off variable and the isy driven thresholds are read from
+    # planner: the SupplyPlanner that decides the levels of the supplies
+    # connected: whether the statuses are current. while not, nothing is recomputed or commanded
+    # profiler: the profiling.Profiler timing every stage of the tick
+    # damper: the damper.Damper following the fresh air damper, None if util.json has none
+    # warmup_timer: the timer waking the loop when a supply is done with its warmup, None if none is waiting
+    # events: the events.EventBuffer the node changes wait in until the next tick
+    # dirty_fans: node addresses of fans that changed since the last recompute
+    # dirty_rooms: rooms whose sensors changed or whose hold time ran out since the last recompute
+    # full: whether the next recompute must re-read every fan and room
+    # event_driven: whether node change events wake the loop
+    # node_subscribers: the listeners on the status events of the fan and sensor nodes
+    # telemetry: the Telemetry every tick is recorded to, if any
+    # reporter: the Reporter the outcome of every tick is written to, if any
+    # net_cfm: the net cfm the last tick ended with, None if it did not balance
+    # ticks: the number of ticks run
+    # last_tick: the wall clock time the last tick finished
+    # wake: set whenever something is marked dirty so the loop recomputes right away
+
+    # this is the constructor method
+    # variables: the Variables to read from, by default one is made and shared with humidity_controller
+    def __init__(self, isy, exhaust_fans_object, supply_fans_object, humidity_controller, variables=None):
+        self.isy = isy
+        self.exhaust_fans_object = exhaust_fans_object
+        self.supply_fans_object = supply_fans_object
+        self.accumulator = exhaust_fans_object.accumulator
+        self.humidity_controller = humidity_controller
+        self.actuator = humidity_controller.actuator
+        self.variables = variables or humidity_controller.variables or Variables(isy)
+        self.variables.bind(IAQ_VARIABLE, 0)
+        self.variables.on_change = self.variable_changed
+        humidity_controller.variables = self.variables
+        self.planner = SupplyPlanner([fan.spec for fan in supply_fans_object.dict.values()], PLAN_QUANTUM)
+        self.events = EventBuffer(EVENT_CAPACITY)
+        self.dirty_fans = set()
+        self.dirty_rooms = set()
+        self.full = True
+        self.event_driven = False
+        self.node_subscribers = []
+        self.telemetry = None
+        self.reporter = None
+        self.net_cfm = None
+        self.ticks = 0
+        self.last_tick = None
+        self.connected = True
+        self.profiler = profiling.Profiler(PERIOD)
+        self.damper = None
+        self.set_damper()
+        self.warmup_timer = None
+        self.actuator.profiler = self.profiler
+        self.wake = asyncio.Event()
+        humidity_controller.on_expire = self.room_expired
+
+    # pyisy reports status and aux property (e.g. CLIHUM) changes on the
+    # status_events of every node, so each fan and sensor node is subscribed to
+    def subscribe(self):
+        self.unsubscribe()
+
+        nodes = {}
+        for fans_object in (self.exhaust_fans_object, self.supply_fans_object):
+            for fan in fans_object.dict.values():
+                nodes[fan.node.address] = fan.node
+        for room in self.humidity_controller.rooms:
+            for node in (room.sens_hum, room.sens_motion):
+                nodes[node.address] = node
+
+        for address, node in nodes.items():
+            self.node_subscribers.append(node.status_events.subscribe(self.node_status_changed, key=address))
+
+    def unsubscribe(self):
+        for subscriber in self.node_subscribers:
+            subscriber.unsubscribe()
+        self.node_subscribers = []
+
+    def node_status_changed(self, event, address):
+        self.node_changed(address, event)
+
+    # called from inside the event processing of pyisy, so the change of a
+    # node that is in use is only buffered until the next tick takes it
+    def node_changed(self, address, event=None):
+        if (address in self.exhaust_fans_object.by_address or address in self.supply_fans_object.by_address
+                or address in self.humidity_controller.by_address):
+            self.events.put(address, event)
+            if self.event_driven:
+                self.wake.set()
+
+    # marks the fans and rooms that use the buffered nodes as dirty.
+    # a full recompute re-reads everything, so it takes the whole buffer
+    def take_events(self, full):
+        # a change was dropped, so every fan and room is re-read
+        if self.events.take_overflow():
+            self.full = full = True
+
+        batch = len(self.events) if full else EVENT_BATCH
+        for address, _ in self.events.drain(batch):
+            if address in self.exhaust_fans_object.by_address or address in self.supply_fans_object.by_address:
+                self.dirty_fans.add(address)
+            rooms = self.humidity_controller.by_address.get(address)
+            if rooms:
+                self.dirty_rooms.update(rooms)
+
+        # the rest of a storm is taken by the next tick, right after this one
+        if self.events:
+            self.wake.set()
+
+    # the hold time of the room ran out, its fan is turned down right away in both modes
+    def room_expired(self, room):
+        self.dirty_rooms.add(room)
+        self.wake.set()
+
+    # an isy variable changed, every room may have a new threshold
+    def variable_changed(self, name=None):
+        self.full = True
+        self.wake.set()
+
+    # the connection to the isy is down. the exhaust fans and rooms are left
+    # where they are rather than commanded from statuses that may be stale, but
+    # the supplies and the damper are turned off, since nothing would turn them
+    # down if the exhaust stopped during the outage
+    def hold(self):
+        self.connected = False
+        self.actuator.held = True
+        for fan in self.supply_fans_object.dict.values():
+            self.actuator.turn_off(fan.node, URGENT)
+        asyncio.ensure_future(self.actuator.flush())
+
+    # the connection is back and the statuses were read again
+    def resume(self):
+        self.connected = True
+        self.actuator.held = False
+        self.full = True
+        self.wake.set()
+
+    # moves everything over to the nodes and variables of another isy,
+    # once the pyisy.ISY a snapshot.WarmISY stood in for is initialized
+    def rebind(self, isy):
+        self.isy = isy
+        self.exhaust_fans_object.rebind(isy)
+        self.supply_fans_object.rebind(isy)
+        self.humidity_controller.rebind(isy)
+        self.variables.rebind(isy)
+        if self.node_subscribers:
+            self.subscribe()
+        self.full = True
+        self.wake.set()
+
+    # applies an edited util.json to the live fans and rooms.
+    # raises ValueError without changing anything if it names a node the isy does not have
+    def reload(self, registry):
+        missing = [name for name in registry.node_names() if not has_node(self.isy, name)]
+        if missing:
+            raise ValueError("nodes not found on the isy: {}".format(", ".join(missing)))
+
+        exhaust = self.exhaust_fans_object.apply(registry.exhaust_fans)
+        supply = self.supply_fans_object.apply(registry.supplies)
+        rooms = self.humidity_controller.apply(registry)
+        self.variables.bind_all(registry.variables)
+        self.planner.set_specs(registry.supplies)
+        self.set_damper()
+        _LOGGER.warning(
+            "Reloaded config. exhaust fans added/changed/removed: %s, supplies: %s, rooms: %s",
+            [len(names) for names in exhaust],
+            [len(names) for names in supply],
+            list(rooms),
+        )
+
+        # new fans and rooms have to be subscribed to as well
+        if self.node_subscribers:
+            self.subscribe()
+
+        self.full = True
+        self.wake.set()
+
+    # values: the variables of the tick, the current ones if not given
+    def iaq_on(self, values=None):
+        if values is None:
+            values = self.variables.values
+        return int(values.get(IAQ_VARIABLE) or 0) == 1
+
+    # follows the supply with the damper role, e.g. after util.json was edited.
+    # a damper that stays the same keeps its state
+    def set_damper(self):
+        fan = self.supply_fans_object.by_role.get(config.DAMPER)
+        if self.damper is not None and fan is not None and self.damper.node_name == fan.spec.node_name:
+            self.damper.travel = fan.spec.travel
+            return
+        if self.damper is not None:
+            self.damper.cancel()
+        self.damper = Damper(fan.spec, bool(fan.value), self.damper_changed) if fan is not None else None
+
+    # the damper is open or closed, the supplies behind it are started or stopped right away
+    def damper_changed(self, state):
+        self.wake.set()
+
+    # wakes the loop at the loop time deadline, when a supply is done with its warmup. None clears the timer
+    def arm_warmup(self, deadline, loop):
+        if self.warmup_timer is not None:
+            if self.warmup_timer.when() == deadline:
+                return
+            self.warmup_timer.cancel()
+            self.warmup_timer = None
+        if deadline is not None:
+            self.warmup_timer = loop.call_at(deadline, self.wake.set)
+
+    # runs one recompute. a full recompute re-reads every fan and room,
+    # otherwise only the ones marked dirty
+    async def tick(self, full=True):
+        if not self.connected:
+            return
+        start = time.perf_counter_ns()
+        profiler = self.profiler
+        self.take_events(full or self.full)
+        full = full or self.full
+        dirty_fans = self.dirty_fans
+        dirty_rooms = self.dirty_rooms
+        self.dirty_fans = set()
+        self.dirty_rooms = set()
+        self.full = False
+
+        # the variables stay the same for the whole tick even if one changes meanwhile
+        values = self.variables.values
+        iaq = self.iaq_on(values)
+
+        # if aqi_tracker.aqi_acceptable():
+        #     isy.nodes["Craw"]
+        # isy.nodes["Double Bathroom"].aux_properties["CLIHUM"].value
+        if iaq:
+            with profiler.stage("check_humidity"):
+                if full:
+                    await self.humidity_controller.check_humidity(values=values)
+                elif dirty_rooms:
+                    await self.humidity_controller.check_humidity(dirty_rooms, values)
+
+        with profiler.stage("fans_update"):
+            if full:
+                self.exhaust_fans_object.update()
+                self.supply_fans_object.update()
+            else:
+                self.exhaust_fans_object.update(dirty_fans)
+                self.supply_fans_object.update(dirty_fans)
+
+        # the relay of the damper switching starts its travel
+        loop = asyncio.get_running_loop()
+        damper_open = True
+        if self.damper is not None:
+            self.damper.follow(self.supply_fans_object.by_role[config.DAMPER].value, loop)
+            damper_open = self.damper.is_open
+
+        exhaust_fans = self.exhaust_fans_object.dict
+        supply_fans = self.supply_fans_object.dict
+
+        # the totals are kept up to date by the fans themselves
+        with profiler.stage("cfm_sums"):
+            exhaust_cfm = self.accumulator.exhaust
+            supply_cfm = self.accumulator.supply
+        net_cfm = float('-inf')
+
+        if iaq:
+            with profiler.stage("balance_cfm"):
+                net_cfm = await balance_cfm(exhaust_fans, supply_fans, exhaust_cfm, self.planner, self.actuator,
+                                            damper_open, loop.time())
+        self.arm_warmup(self.planner.next_deadline(loop.time()) if iaq else None, loop)
+
+        if self.reporter is not None:
+            state = {
+                "exhaust_cfm": exhaust_cfm,
+                "supply_cfm": supply_cfm,
+                "net_cfm": net_cfm if iaq else None,
+                "iaq": values.get(IAQ_VARIABLE),
+                "supplies": {node_name: fan.value for node_name, fan in supply_fans.items()},
+            }
+            self.reporter.report(state, lambda: self.console_dump(exhaust_cfm, supply_cfm, net_cfm, values))
+
+        if self.telemetry is not None:
+            self.telemetry.record(self.snapshot(exhaust_cfm, supply_cfm, net_cfm if iaq else None, int(iaq),
+                                                None if full else (dirty_fans, dirty_rooms)))
+
+        self.net_cfm = net_cfm if iaq else None
+        self.ticks += 1
+        self.last_tick = time.time()
+        profiler.tick(time.perf_counter_ns() - start)
+
+    # the verbose output of a tick for the human report mode
+    def console_dump(self, exhaust_cfm, supply_cfm, net_cfm, values):
+        lines = []
+        # for fan in self.exhaust_fans_object.dict.values():
+        #     lines.append(str(fan))
+        for fan in self.supply_fans_object.dict.values():
+            lines.append(str(fan))
+
+        lines.append("{}TOTAL EXHAUST CFM: {}{}".format(color.BOLD, exhaust_cfm, color.END))
+        lines.append("{}TOTAL SUPPLY CFM: {}{}".format(color.BOLD, supply_cfm, color.END))
+        if self.iaq_on(values):
+            lines.append("{}NET CFM: {}{}".format(color.BOLD, net_cfm, color.END))
+        else:
+            lines.append("{}NOT BALANCING BECAUSE IAQ var = {} {}".format(
+                color.BOLD, values.get(IAQ_VARIABLE), color.END))
+        lines.append(color.BOLD + time.ctime(time.time()) + color.END)
+        lines.append("-----------------------------------------")
+        return "\n".join(lines)
+
+    # the state of the fans and rooms for the telemetry.
+    # dirty: the (fan addresses, rooms) the tick looked at, only those and the
+    # supplies the planner sets are in the snapshot. None for every fan and room
+    def snapshot(self, exhaust_cfm, supply_cfm, net_cfm, iaq, dirty=None):
+        fans = {}
+        if dirty is None:
+            for fans_object in (self.exhaust_fans_object, self.supply_fans_object):
+                for node_name, fan in fans_object.dict.items():
+                    fans[node_name] = fan.value
+            rooms = self.humidity_controller.rooms
+        else:
+            dirty_fans, rooms = dirty
+            for address in dirty_fans:
+                fan = self.exhaust_fans_object.by_address.get(address)
+                if fan is not None:
+                    fans[fan.spec.node_name] = fan.value
+            for node_name, fan in self.supply_fans_object.dict.items():
+                fans[node_name] = fan.value
+
+        rooms = {room.sens_hum.name: (humidity.reported_hum(room.sens_hum), room.sens_motion.status) for room in rooms}
+        return telemetry.Snapshot(time.time(), exhaust_cfm, supply_cfm, net_cfm, iaq, fans, rooms)
+
+    async def run(self, event_driven=False):
+        self.event_driven = event_driven
+        if not event_driven:
+            next_tick = time.monotonic() + PERIOD
+            last_sweep = time.monotonic()
+            while True:
+                # this is the period for the clock cycle of the program
+                # without this the program would always be running at full speed.
+                # only a room whose hold time ran out cuts the wait short
+                try:
+                    await asyncio.wait_for(self.wake.wait(), max(0, next_tick - time.monotonic()))
+                except asyncio.TimeoutError:
+                    next_tick = time.monotonic() + PERIOD
+                    # while the node events are followed only the fans and rooms they
+                    # marked dirty and the rooms whose timers fired are looked at, like
+                    # the event driven loop, with a full re-read every SWEEP_PERIOD
+                    sweep = not self.node_subscribers or time.monotonic() - last_sweep >= SWEEP_PERIOD
+                    if sweep:
+                        last_sweep = time.monotonic()
+                    await self.tick(full=sweep)
+                    continue
+                self.wake.clear()
+                await self.tick(full=False)
+
+        last_sweep = time.monotonic()
+        while True:
+            # sleep until an event marks something dirty, a timer runs out,
+            # or it is time for the safety sweep. the hold times of the rooms, the
+            # travel of the damper and the warmups of the supplies have timers of their own
+            wake_at = last_sweep + SWEEP_PERIOD
+
+            try:
+                await asyncio.wait_for(self.wake.wait(), max(0, wake_at - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+
+            sweep = time.monotonic() - last_sweep >= SWEEP_PERIOD
+            if sweep:
+                last_sweep = time.monotonic()
+            await self.tick(full=sweep)
+
+
+# the keyword arguments after event_driven let supervisor.py run many sites in
+# one process. name is added to every report line, on_controller is called with
+# the Controller once it runs
+async def main(url, username, password, tls_ver, events, node_servers, event_driven=False,
+               config_path=config.CONFIG_PATH, config_cache=CONFIG_CACHE, http_port=HTTP_PORT,
+               telemetry_db=TELEMETRY_DB, name=None, on_controller=None, warm_start=WARM_START,
+               profile=False, record=RECORD_PATH):
     """Execute connection to ISY and load all system info."""
     _LOGGER.info("Starting PyISY...")
     t_0 = time.time()
@@ -59,21 +510,40 @@ async def main(url, username, password, tls_ver, events, node_servers):
     )
 
     try:
-        await isy.initialize(node_servers)
-    except (ISYInvalidAuthError, ISYConnectionError):
-        _LOGGER.error(
-            "Failed to connect to the ISY, please adjust settings and try again."
-        )
-        await isy.shutdown()
-        return
-    except Exception as err:
-        _LOGGER.error("Unknown error occurred: %s", err.args[0])
+        registry = config.load_registry(config_path, config_cache)
+    except Exception:
         await isy.shutdown()
         raise
-
-    # Print a representation of all the Nodes
-    # _LOGGER.debug(repr(isy.nodes))
-    _LOGGER.info("Total Loading time: %.2fs", time.time() - t_0)
+    warm = snapshot.load(warm_start) if warm_start else None
+    if warm is not None and not snapshot.covers(warm, registry, {IAQ_VARIABLE}):
+        _LOGGER.warning("The snapshot does not have every node and variable of %s, starting cold", config_path)
+        warm = None
+    elif warm is not None and time.time() - warm["time"] > WARM_START_MAX_AGE:
+        _LOGGER.warning("The snapshot is %.0fs old, over WARM_START_MAX_AGE, starting cold",
+                        time.time() - warm["time"])
+        warm = None
+    if warm is None:
+        try:
+            await isy.initialize(node_servers)
+        except (ISYInvalidAuthError, ISYConnectionError):
+            _LOGGER.error(
+                "Failed to connect to the ISY, please adjust settings and try again."
+            )
+            await isy.shutdown()
+            return
+        except Exception as err:
+            _LOGGER.error("Unknown error occurred: %s", err.args[0])
+            await isy.shutdown()
+            raise
+
+        # Print a representation of all the Nodes
+        # _LOGGER.debug(repr(isy.nodes))
+        _LOGGER.info("Total Loading time: %.2fs", time.time() - t_0)
+        site = isy
+    else:
+        # control starts from the snapshot, the isy is initialized in the background
+        site = snapshot.WarmISY(isy, warm)
+        _LOGGER.warning("Warm start from a snapshot %.0fs old", site.age)
 
     node_changed_subscriber = None
     system_status_subscriber = None
@@ -87,12 +557,24 @@ async def main(url, username, password, tls_ver, events, node_servers):
         #     event_desc,
         #     event.event_info if event.event_info else "",
         #     )
+        if controller is not None:
+            controller.node_changed(event.address, event)
 
     def system_status_handler(event: str) -> None:
         """Handle a system status changed event sent ISY class."""
         # _LOGGER.info("System Status Changed: %s", SYSTEM_STATUS.get(event))
 
-    try:
+    controller = None
+    variables = None
+    watcher_task = None
+    status_server = None
+    connection_manager = None
+    initialize_task = None
+    recorder = None
+
+    # the isy is initialized, so its events can be followed
+    def ready():
+        nonlocal node_changed_subscriber, system_status_subscriber, connection_manager, recorder
         if events:
             isy.websocket.start()
             node_changed_subscriber = isy.nodes.status_events.subscribe(
@@ -101,220 +583,177 @@ async def main(url, username, password, tls_ver, events, node_servers):
             system_status_subscriber = isy.status_events.subscribe(
                 system_status_handler
             )
+            controller.subscribe()
+            connection_manager = connection.ConnectionManager(isy, controller, RECONNECT_MIN, RECONNECT_MAX)
+            connection_manager.start()
+        if warm_start:
+            snapshot.save(warm_start, controller)
+        # recording starts with the real isy, after a warm start that is once it is initialized
+        if record:
+            recorder = replay.Recorder(record, config_path)
+            recorder.start(controller)
+
+    async def initialize_in_background():
+        delay = RECONNECT_MIN
+        while True:
+            try:
+                await isy.initialize(node_servers)
+                break
+            except Exception as err:
+                _LOGGER.error("Could not initialize the ISY, retrying in %.0fs: %s", delay, err)
+                await asyncio.sleep(delay)
+                delay = min(RECONNECT_MAX, delay * 2)
+        _LOGGER.warning("ISY initialized after %.2fs, leaving the snapshot", time.time() - t_0)
+        # nodes that were renamed or removed since the snapshot raise here, like on a cold start
+        controller.rebind(isy)
+        ready()
+
+    # set when the switch over failed, so main raises it instead of the cancellation
+    init_error = None
+
+    def initialized(task):
+        nonlocal init_error
+        if not task.cancelled() and task.exception() is not None:
+            _LOGGER.error("Could not switch over to the ISY: %r", task.exception())
+            init_error = task.exception()
+            main_task.cancel()
+
+    main_task = asyncio.current_task()
+
+    # SIGUSR1 starts the sampling profiler, the next one writes what it saw to PROFILE_PATH
+    sampler = profiling.SamplingProfiler()
+
+    def toggle_sampler():
+        if sampler.running:
+            sampler.stop()
+            sampler.dump(PROFILE_PATH)
+        else:
+            _LOGGER.warning("Sampling profiler started")
+            sampler.start()
+
+    if profile:
+        sampler.start()
+    # under supervisor.py many sites share the process, so only a lone site takes the signal
+    if name is None:
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, toggle_sampler)
+        except (NotImplementedError, AttributeError, RuntimeError):
+            pass
 
+    try:
         # -----------------------------------------
         # CLAY HUANG CODE STARTS HERE
         # -----------------------------------------
 
-        with open("util.json", "r") as file:
-            file_data = json.load(file)
-
-            exhaust_fans_object = ExhaustFans(isy, file_data.get("exhaust_fan_node_names"))
-            supply_fans_object = SupplyFans(isy, file_data.get("supply_fan_node_names"))
-            humidity_controller = humidity.Humidity(isy, file_data)
-        # aqi_tracker = AQITracker.AQITracker()
-
-        while True:
-            # this is the period for the clock cycle of the program
-            # without this the program would always be running at full speed
-            await asyncio.sleep(1)
-
-            # if aqi_tracker.aqi_acceptable():
-            #     isy.nodes["Craw"]
-            # isy.nodes["Double Bathroom"].aux_properties["CLIHUM"].value
-            if int(isy.variables.get_by_name("IAQ_on_off").status) == 1:
-                await humidity_controller.check_humidity()
-
-            exhaust_fans_object.update()
-            supply_fans_object.update()
-
-            exhaust_fans = exhaust_fans_object.dict
-            supply_fans = supply_fans_object.dict
-
-            exhaust_cfm = await get_exhaust_cfm(exhaust_fans)
-            supply_cfm = await get_supply_cfm(supply_fans)
-            net_cfm = float('-inf')
-
-            if int(isy.variables.get_by_name("IAQ_on_off").status) == 1:
-                net_cfm = await balance_cfm(exhaust_fans, supply_fans, exhaust_cfm, supply_cfm)
-
-            # for exhaust_fan in exhaust_fans:
-            #     fan = exhaust_fans[exhaust_fan]
-            #     print(fan)
-            #
-            for supply_fan in supply_fans:
-                fan = supply_fans[supply_fan]
-                print(fan)
-
-            print("{}TOTAL EXHAUST CFM: {}{}".format(color.BOLD, exhaust_cfm, color.END))
-            print("{}TOTAL SUPPLY CFM: {}{}".format(color.BOLD, supply_cfm, color.END))
-            # print(isy.variables.get_by_name("IAQ_on_off").status)
-            # print(int(isy.variables.get_by_name("IAQ_on_off").status) == 1)
-            if int(isy.variables.get_by_name("IAQ_on_off").status) == 1:
-                print("{}NET CFM: {}{}".format(color.BOLD, net_cfm, color.END))
-            else:
-                print("{}NOT BALANCING BECAUSE IAQ var = {} {}".format(color.BOLD,
-                                                                       isy.variables.get_by_name("IAQ_on_off").status,
-                                                                       color.END))
-            print(color.BOLD + time.ctime(time.time()) + color.END)
-            print("-----------------------------------------")
+        accumulator = FanTable() if COMPACT_FANS else CFMAccumulator()
+        exhaust_fans_object = ExhaustFans(site, registry.exhaust_fans, accumulator)
+        supply_fans_object = SupplyFans(site, registry.supplies, accumulator)
+        actuator = Actuator(COMMAND_DEBOUNCE, COMMAND_CONCURRENCY, COMMAND_TIMEOUT, COMMAND_DEADLINE)
+        # every isy variable is looked up once here and then followed through its events
+        variables = Variables(site)
+        variables.bind_all(registry.variables)
+        humidity_controller = humidity.Humidity(site, registry, actuator, variables)
+        # aqi_tracker = AQITracker.AQITracker(websession, ttl=AQI_TTL)
+        # aqi_tracker.start()
+
+        controller = Controller(site, exhaust_fans_object, supply_fans_object, humidity_controller, variables)
+        if warm is None:
+            ready()
+        else:
+            initialize_task = asyncio.create_task(initialize_in_background())
+            initialize_task.add_done_callback(initialized)
+        controller.reporter = report.Reporter(REPORT_MODE, REPORT_INTERVAL,
+                                              fields={"site": name} if name else None)
+        controller.reporter.start()
+        if http_port:
+            status_server = server.StatusServer(controller, port=http_port)
+            await status_server.start()
+        if telemetry_db:
+            controller.telemetry = telemetry.Telemetry(telemetry_db)
+            controller.telemetry.start()
+        if RELOAD_INTERVAL > 0:
+            watcher = reload.ConfigWatcher(config_path, controller.reload, RELOAD_INTERVAL, config_cache)
+            watcher_task = asyncio.create_task(watcher.run())
+        if on_controller is not None:
+            on_controller(controller)
+        await controller.run(event_driven=events and event_driven)
 
     except asyncio.CancelledError:
-        pass
+        # the cleanup below still runs, but whoever cancelled main (e.g.
+        # supervisor.py stopping the site) has to see the cancellation
+        if init_error is not None:
+            raise init_error
+        raise
     finally:
+        if sampler.running:
+            sampler.stop()
+            sampler.dump(PROFILE_PATH)
+        if initialize_task:
+            initialize_task.cancel()
+        if watcher_task:
+            watcher_task.cancel()
+        if connection_manager:
+            await connection_manager.stop()
+        if status_server:
+            await status_server.stop()
+        if recorder is not None:
+            recorder.stop()
+        if controller is not None:
+            controller.unsubscribe()
+            await controller.actuator.stop()
+            # the last statuses, for the next warm start. while the controller still
+            # runs on the snapshot its statuses are no newer than the file, which
+            # keeps its time so WARM_START_MAX_AGE still applies to it
+            if warm_start and controller.isy is isy:
+                snapshot.save(warm_start, controller)
+            if controller.telemetry is not None:
+                controller.telemetry.stop()
+            if controller.reporter is not None:
+                controller.reporter.stop()
         if node_changed_subscriber:
             node_changed_subscriber.unsubscribe()
         if system_status_subscriber:
             system_status_subscriber.unsubscribe()
+        if variables is not None:
+            variables.close()
         await isy.shutdown()
 
 
-# This method returns the total exhaust cfm of all the fans
-async def get_exhaust_cfm(exhaust_fans):
-    cfm_ventahood = 0
-    cfm = 0
-    for exhaust_fan in exhaust_fans:
-        fan = exhaust_fans[exhaust_fan]
-        # print(fan)
-
-        if fan.type == "bool":
-            cfm += fan.value and fan.cfm
-            # if fan.name.__contains__("Ventahood"):
-            #     cfm_ventahood += fan.value and fan.cfm
-            # else:
-            #     cfm += fan.value and fan.cfm
-
-        if type(fan.type) == int:
-            ratio = 1 / fan.type
-            # print(fan.cfm)
-            # print(fan.name)
-            # print(fan.value)
-            # print(ratio)
-            # print(fan.cfm * fan.value * ratio)
-            cfm += round(fan.cfm * fan.value * ratio)
-            # if fan.name.__contains__("Ventahood"):
-            #     cfm_ventahood += round(fan.cfm * fan.value * ratio)
-            # else:
-            #     cfm += round(fan.cfm * fan.value * ratio)
-
-    return cfm
-    # return (cfm, cfm_ventahood)
-
-
-async def get_supply_cfm(supply_fans):
-    cfm = 0
-    for supply_fan in supply_fans:
-        fan = supply_fans[supply_fan]
-        # print(fan)
-
-        if fan.type == "bool":
-            cfm += fan.value and fan.cfm
-
-        if type(fan.type) == int:
-            ratio = 1 / fan.type
-            cfm += round(fan.cfm * fan.value * ratio)
-
-    return cfm
-
-
-async def get_fan(exhaust_fans, supply_fans, node_name):
-    for fan in exhaust_fans:
-        if fan == node_name:
-            return exhaust_fans[fan]
-    for fan in supply_fans:
-        if fan == node_name:
-            return supply_fans[fan]
-
-
-async def turn_off_supplies(damper, fan_12_inch, fan_8_inch):
-    await damper.node.turn_off()
-    await fan_12_inch.node.turn_off()
-    await fan_8_inch.node.turn_off()
-
-
-# returns the CFM the supply fan is set to
-async def turn_on_supply(fan, net_cfm):
-    # print("fan status: " + str(fan.node.status))
-    fan_percentage = min(1, net_cfm / fan.cfm)
-    # print("fan percentage: " + str(fan_percentage))
-    cfm_of_fan = round(fan_percentage * fan.cfm)
-    print("Turning on fan for {} cfm".format(cfm_of_fan))
-    on_level = round(fan_percentage * 255)
-    fan.value = on_level
-    if fan.node.status != int(on_level):
-        await fan.node.turn_on(int(on_level))
-    return cfm_of_fan
-
-
-async def balance_cfm(exhaust_fans, supply_fans, exhaust_cfm, supply_cfm):
-    DAMPER = "n001_output_33"
-    FRESH_AIR_FAN_12_INCH = "53 23 84 1"
-    FRESH_AIR_FAN_8_INCH = "53 25 DA 1"
-
-    damper = await get_fan(exhaust_fans, supply_fans, DAMPER)
-    fan_12_inch = await get_fan(exhaust_fans, supply_fans, FRESH_AIR_FAN_12_INCH)
-    fan_8_inch = await get_fan(exhaust_fans, supply_fans, FRESH_AIR_FAN_8_INCH)
-
-    fan_12_inch_reset = (0, False)
-
-    net_cfm = exhaust_cfm
-
-    if net_cfm > 0:
-
-        # print(exhaust_fans)
-        if exhaust_fans["n001_zone_38"].value == 2:
-            fan_12_inch_reset = (await turn_on_supply(fan_12_inch, net_cfm), True)
-            net_cfm -= fan_12_inch_reset[0]
-
-        if net_cfm > 0:
-            # if the damper is closed...
-            if damper.value == 0:
-                print("Opening the fresh air damper")
-                print("Status before: " + str(damper.node.status))
-                await damper.node.turn_on()
-                print("status after: " + str(damper.node.status))
-
-                damper.time_off = time.time()
-            net_cfm -= damper.cfm
-        elif damper.node.status != 0:
-            print("turning off damper")
-            await damper.node.turn_off()
-
-        # if more supply is needed...
-        if net_cfm > 0:
-
-            # if the damper is fully open
-            if time.time() - damper.time_off > 33:
-                net_cfm -= await turn_on_supply(fan_8_inch, net_cfm)
-
-            else:
-                print("damper not open yet")
-
-            # if more supply is needed...
-            if net_cfm > 0:
-                if fan_12_inch_reset[1]:
-                    net_cfm -= await turn_on_supply(fan_12_inch, net_cfm + fan_12_inch_reset[0])
-                else:
-                    net_cfm -= await turn_on_supply(fan_12_inch, net_cfm)
-            elif not fan_12_inch_reset[0]:
-                await fan_12_inch.node.turn_off()
-
-        else:
-            if fan_12_inch.node.status != 0 and not fan_12_inch_reset[1]:
-                await fan_12_inch.node.turn_off()
-            if fan_8_inch.node.status != 0:
-                await fan_8_inch.node.turn_off()
+# whether the isy has a node with the name or address. pyisy nodes have no "in"
+def has_node(isy, key):
+    try:
+        isy.nodes[key]
+    except KeyError:
+        return False
+    return True
 
-    elif supply_cfm > 0:
-        if damper.node.status != 0 or fan_12_inch.node.status != 0 or fan_8_inch.node.status != 0:
-            await turn_off_supplies(damper, fan_12_inch, fan_8_inch)
 
-    return net_cfm
+# planner: the SupplyPlanner that decides the levels of the supplies
+# actuator: the Actuator the commands are sent through, all at once at the end.
+# damper_open: whether the damper is open, see damper.Damper.
+# now: the loop time the warmups of the supplies are timed with, the current one if not given.
+# returns the exhaust cfm the supplies do not make up for
+async def balance_cfm(exhaust_fans, supply_fans, exhaust_cfm, planner, actuator, damper_open=True, now=None):
+    if now is None:
+        now = asyncio.get_running_loop().time()
+    levels, supplied = planner.plan(exhaust_cfm, exhaust_fans, supply_fans, now, damper_open)
+    planner.apply(levels, supply_fans, actuator)
+    await actuator.flush()
+    return exhaust_cfm - supplied
 
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description="Balance the fresh air supply against the exhaust fans.")
+    parser.add_argument("--profile", action="store_true",
+                        help="run the sampling profiler from the start and write it to PROFILE_PATH at exit")
+    args = parser.parse_args()
+
     enable_logging(logging.WARNING)
+    if REPORT_MODE == report.HUMAN:
+        # the balance and damper messages are logged by the modules doing the balancing
+        for name in (__name__, "planner", "damper"):
+            logging.getLogger(name).setLevel(logging.DEBUG)
 
     _LOGGER.info(
         "ISY URL: %s, username: %s",
@@ -331,6 +770,8 @@ if __name__ == "__main__":
                 tls_ver=1.1,
                 events=True,
                 node_servers=False,
+                event_driven=EVENT_DRIVEN,
+                profile=args.profile,
             )
         )
     except KeyboardInterrupt:
@@ -0,0 +1,170 @@
+import logging
+import math
+
+from actuator import URGENT
+from curve import fan_curve
+
+_LOGGER = logging.getLogger(__name__)
+
+# the exhaust cfm is rounded up to a multiple of this before planning,
+# so nearby totals share one memoized plan
+QUANTUM = 5
+
+# at most this many plans are memoized, the oldest are dropped after that
+MAX_PLANS = 4096
+
+
+class SupplyPlanner:
+
+    # decides the level of every supply for an exhaust cfm, from the supply
+    # specs in util.json instead of a fixed chain of fans.
+    #
+    # the supplies are filled in order of priority: each one takes as much of
+    # the exhaust as it can (on/off supplies all of their cfm, scaled supplies
+    # just enough, but never less than their min_level) until the exhaust is
+    # made up for, and the rest are turned off. a supply that draws through the
+    # damper is left out until the damper is open, a supply with a warmup is
+    # left out until the supplies have been running for that long, and a supply
+    # whose first_when matches the exhaust fans is filled before all others.
+    #
+    # the order of the supplies for every combination of left out and moved up
+    # supplies is worked out once, and the plans are memoized by the exhaust
+    # cfm rounded up to a multiple of quantum, so a tick is a dict lookup
+
+    # FIELDS
+    #
+    # specs: the config.FanSpecs of the supplies, sorted by priority
+    # quantum: the cfm the exhaust is rounded up to a multiple of
+    # orders: the supplies to fill, in order, as (index, cfm, type, min_level, curve),
+    #         keyed by (left out mask, moved up mask)
+    # plans: the memoized plans as (levels, supplied cfm), keyed by
+    #        (quantized exhaust cfm, left out mask, moved up mask)
+    # after_damper: the supplies that wait for the damper, as a bit mask
+    # started: the loop time the supplies were turned on, None while they are off
+    # last_levels: the levels of the last plan, for logging changes
+
+    # this is the constructor method
+    def __init__(self, specs, quantum=QUANTUM):
+        self.quantum = quantum
+        self.started = None
+        self.last_levels = None
+        self.set_specs(specs)
+
+    # takes new specs, e.g. when util.json was edited
+    def set_specs(self, specs):
+        indexed = sorted(enumerate(specs), key=lambda item: (item[1].priority, item[0]))
+        self.specs = tuple(spec for _, spec in indexed)
+        self.after_damper = 0
+        for i, spec in enumerate(self.specs):
+            if spec.after_damper:
+                self.after_damper |= 1 << i
+        self.orders = {}
+        self.plans = {}
+        self.last_levels = None
+
+    # the supplies that still wait for their warmup at the loop time now, as a bit mask
+    def waiting(self, now):
+        mask = 0
+        for i, spec in enumerate(self.specs):
+            if spec.warmup and (self.started is None or now - self.started < spec.warmup):
+                mask |= 1 << i
+        return mask
+
+    # the next loop time after now a supply is done with its warmup, None if none is waiting
+    def next_deadline(self, now):
+        if self.started is None:
+            return None
+        deadlines = [self.started + spec.warmup for spec in self.specs if self.started + spec.warmup > now]
+        return min(deadlines) if deadlines else None
+
+    # the supplies that are moved up by the values of the exhaust fans, as a bit mask
+    def moved_up(self, exhaust_fans):
+        mask = 0
+        for i, spec in enumerate(self.specs):
+            for node_name, value in spec.first_when:
+                fan = exhaust_fans.get(node_name)
+                if fan is not None and fan.value == value:
+                    mask |= 1 << i
+                    break
+        return mask
+
+    def order(self, waiting, moved_up):
+        key = (waiting, moved_up)
+        order = self.orders.get(key)
+        if order is None:
+            first, rest = [], []
+            for i, spec in enumerate(self.specs):
+                if waiting >> i & 1:
+                    continue
+                curve = fan_curve(spec.curve, spec.type) if spec.curve else None
+                (first if moved_up >> i & 1 else rest).append((i, spec.cfm, spec.type, spec.min_level, curve))
+            order = self.orders[key] = tuple(first + rest)
+        return order
+
+    # the levels of the supplies (aligned with specs) and the cfm they supply.
+    # a level is 0 for off, None for turning an on/off supply on, or the level of a scaled supply
+    def allocate(self, target, order):
+        levels = [0] * len(self.specs)
+        supplied = 0
+        for i, cfm, fan_type, min_level, curve in order:
+            remaining = target - supplied
+            if remaining <= 0:
+                break
+            if fan_type == "bool":
+                levels[i] = None
+                supplied += cfm
+            elif curve is not None:
+                # the lowest level of the measured curve that moves what is left
+                levels[i] = curve.level(max(min(curve.max_cfm, remaining), min_level * curve.max_cfm))
+                supplied += curve.forward[levels[i]]
+            else:
+                fraction = max(min(1, remaining / cfm), min_level)
+                levels[i] = round(fraction * fan_type)
+                supplied += round(fraction * cfm)
+        return tuple(levels), supplied
+
+    # returns the plan for the exhaust cfm at the loop time now.
+    # exhaust_fans: the exhaust fans keyed by node name, for first_when
+    # supply_fans: the supplies keyed by node name, to tell whether they already run
+    # damper_open: whether the supplies that draw through the damper may run
+    def plan(self, exhaust_cfm, exhaust_fans, supply_fans, now, damper_open=True):
+        if exhaust_cfm <= 0:
+            self.started = None
+        elif self.started is None:
+            # supplies that already run (e.g. after a restart) are taken as warmed up
+            running = any(fan.value for fan in supply_fans.values())
+            self.started = float("-inf") if running else now
+
+        steps = math.ceil(exhaust_cfm / self.quantum) if exhaust_cfm > 0 else 0
+        waiting = self.waiting(now)
+        if not damper_open:
+            waiting |= self.after_damper
+        moved_up = self.moved_up(exhaust_fans) if steps else 0
+        key = (steps, waiting, moved_up)
+
+        plan = self.plans.get(key)
+        if plan is None:
+            if len(self.plans) >= MAX_PLANS:
+                del self.plans[next(iter(self.plans))]
+            plan = self.plans[key] = self.allocate(steps * self.quantum, self.order(waiting, moved_up))
+
+        if plan[0] != self.last_levels:
+            self.last_levels = plan[0]
+            _LOGGER.debug("Supplying %s cfm for %s exhaust cfm: %s", plan[1], exhaust_cfm,
+                          ", ".join("{}={}".format(spec.name, level) for spec, level in zip(self.specs, plan[0])))
+        return plan
+
+    # requests the levels of the plan from the actuator
+    def apply(self, levels, supply_fans, actuator):
+        for spec, level in zip(self.specs, levels):
+            fan = supply_fans.get(spec.node_name)
+            if fan is None:
+                continue
+            if level == 0:
+                actuator.turn_off(fan.node, URGENT)
+            elif level is None:
+                actuator.turn_on(fan.node)
+            else:
+                # counted right away so the next tick does not ask for the same cfm again
+                fan.value = level
+                actuator.turn_on(fan.node, level)
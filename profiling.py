@@ -0,0 +1,208 @@
+import collections
+import logging
+import sys
+import threading
+import time
+
+# every power of two range of a histogram is split into this many buckets,
+# which keeps every recorded value within 1/SUB_BUCKETS (about 3%) of its bucket
+SUB_BUCKETS = 32
+SUB_BITS = 5
+
+# seconds between two samples of the sampling profiler
+SAMPLE_INTERVAL = 0.005
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Histogram:
+
+    # an hdr style histogram of durations in nanoseconds. the buckets grow
+    # log-linearly, so recording is a couple of integer operations and a few
+    # hundred buckets cover everything from a microsecond to minutes with a
+    # bounded relative error
+
+    # FIELDS
+    #
+    # counts: the number of values in every bucket, keyed by bucket index
+    # count: the number of values recorded
+    # total: the sum of the values recorded
+    # max: the largest value recorded
+
+    # this is the constructor method
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @staticmethod
+    def index(value):
+        if value < SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - SUB_BITS - 1
+        return ((shift + 1) << SUB_BITS) + (value >> shift) - SUB_BUCKETS
+
+    # the largest value that falls into the bucket
+    @staticmethod
+    def upper(index):
+        if index < SUB_BUCKETS:
+            return index
+        shift = (index >> SUB_BITS) - 1
+        return ((SUB_BUCKETS + (index & (SUB_BUCKETS - 1)) + 1) << shift) - 1
+
+    def record(self, value):
+        self.counts[self.index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    # the value below which the fraction of the recorded values falls
+    def percentile(self, fraction):
+        if not self.count:
+            return 0
+        rank = max(1, round(self.count * fraction))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self.upper(index), self.max)
+        return self.max
+
+    def reset(self):
+        self.counts.clear()
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+
+class Stage:
+
+    # times one stage of the tick with "with profiler.stage(name):", also around awaits
+
+    __slots__ = ("histogram", "start")
+
+    # this is the constructor method
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.record(time.perf_counter_ns() - self.start)
+
+
+class Profiler:
+
+    # keeps a histogram of the duration of every stage of the tick and of
+    # every command round trip to the isy, and counts the ticks that took
+    # longer than the period of the loop
+
+    # FIELDS
+    #
+    # histograms: the Histogram of every stage, keyed by stage name
+    # stages: the Stage of every stage, made once so timing a stage allocates nothing
+    # period: seconds a tick may take before it counts as an overrun
+    # overruns: the number of ticks that took longer than period
+
+    # this is the constructor method
+    def __init__(self, period=1):
+        self.histograms = {}
+        self.stages = {}
+        self.period = period
+        self.overruns = 0
+
+    def stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            self.histograms[name] = Histogram()
+            stage = self.stages[name] = Stage(self.histograms[name])
+        return stage
+
+    # records a duration measured elsewhere, in nanoseconds
+    def record(self, name, nanoseconds):
+        self.stage(name).histogram.record(nanoseconds)
+
+    # records the duration of a whole tick and counts it if it overran
+    def tick(self, nanoseconds):
+        self.record("tick", nanoseconds)
+        if nanoseconds > self.period * 1e9:
+            self.overruns += 1
+
+    # the percentiles of every stage in seconds, for the status page and metrics
+    def summary(self, fractions=(0.5, 0.9, 0.99, 1)):
+        summary = {}
+        for name, histogram in self.histograms.items():
+            summary[name] = {
+                "count": histogram.count,
+                "sum": histogram.total / 1e9,
+                "quantiles": {fraction: histogram.percentile(fraction) / 1e9 for fraction in fractions},
+            }
+        return summary
+
+
+class SamplingProfiler:
+
+    # a sampling profiler for finding where the loop spends its time without
+    # slowing it down much: a background thread looks at the stack of the
+    # loop thread every interval seconds and counts every stack it sees.
+    # the counts are written in the collapsed stack format flamegraph tools read
+
+    # FIELDS
+    #
+    # thread_id: the id of the thread that is sampled
+    # interval: seconds between two samples
+    # stacks: how many times every stack was seen, keyed by the collapsed stack
+    # samples: the number of samples taken
+    # stopping: set to stop sampling
+    # thread: the sampling thread while it runs
+
+    # this is the constructor method
+    def __init__(self, thread_id=None, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name="sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{}:{}".format(code.co_filename.rsplit("/", 1)[-1], code.co_name))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    # writes the stacks seen, most common first, and starts counting again
+    def dump(self, path):
+        with open(path, "w") as file:
+            for stack, count in self.stacks.most_common():
+                file.write("{} {}\n".format(stack, count))
+        _LOGGER.warning("Wrote %d samples of %d stacks to %s", self.samples, len(self.stacks), path)
+        self.stacks.clear()
+        self.samples = 0
@@ -0,0 +1,70 @@
+import asyncio
+import logging
+import os
+
+import config
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class ConfigWatcher:
+
+    # watches util.json and hands a freshly loaded registry to on_change every
+    # time the file is saved, so edits are applied without restarting the isy session.
+    # the file is polled by modification time, which works the same on every
+    # platform and inside the container
+
+    # FIELDS
+    #
+    # path: the config file that is watched
+    # cache_path: the optional config cache, see config.load_registry
+    # interval: seconds between checks of the file
+    # on_change: called with the new config.Registry after the file changed
+    # last_key: the modification time and size of the file when it was last loaded
+
+    # this is the constructor method
+    def __init__(self, path, on_change, interval=5, cache_path=None):
+        self.path = path
+        self.cache_path = cache_path
+        self.interval = interval
+        self.on_change = on_change
+        self.last_key = self.file_key()
+
+    def file_key(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    # loads the file if it changed since the last check.
+    # returns whether a new registry was handed to on_change
+    def check(self):
+        key = self.file_key()
+        if key is None or key == self.last_key:
+            return False
+        self.last_key = key
+
+        try:
+            registry = config.load_registry(self.path, self.cache_path)
+        except (OSError, ValueError) as err:
+            # a half written or invalid file keeps the old config running
+            _LOGGER.error("Not reloading %s: %s", self.path, err)
+            return False
+
+        try:
+            self.on_change(registry)
+        except ValueError as err:
+            # e.g. a node the isy does not have, the old config keeps running
+            _LOGGER.error("Not applying %s: %s", self.path, err)
+            return False
+        return True
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            # a failed check must not end the watcher, the next edit is tried again
+            try:
+                self.check()
+            except Exception:
+                _LOGGER.exception("Could not reload %s", self.path)
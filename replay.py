@@ -0,0 +1,402 @@
+# records the events of a site and replays them through the control logic.
+#
+# with RECORD_PATH set, main.py appends every node and variable change the
+# controller sees and every command it sends to that file, one short json list
+# per line with the monotonic seconds since the recording started.
+#
+# `python3 replay.py FILE` feeds the changes back through the fans, rooms and
+# balance_cfm on a fake isy, as fast as possible by default or in real time
+# with `--realtime`, and prints where the commands differ from the recorded
+# ones. `--config` replays against another util.json than the recorded one.
+import argparse
+import asyncio
+import difflib
+import itertools
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+
+from pyisy.constants import PROP_STATUS
+
+import config
+import humidity
+import main
+import snapshot
+from actuator import Actuator
+from cfm import CFMAccumulator
+from fake_isy import VARIABLE, FakeISY
+from fan import ExhaustFans, SupplyFans
+from variables import Variables
+
+# bump this whenever the layout of a recording changes
+RECORD_VERSION = 1
+
+# the control of a command entry, and of one the isy did not accept
+COMMAND = "CMD"
+FAILED = "ERR"
+# the control of the entry written when the recording stops
+END = "END"
+
+_LOGGER = logging.getLogger(__name__)
+
+
+# the status and aux property values of a node, keyed by control
+def node_state(node):
+    state = {control: prop.value for control, prop in node.aux_properties.items()}
+    state[PROP_STATUS] = node.status
+    return state
+
+
+class Recorder:
+
+    # appends what the controller sees and does to a file. every recording
+    # starts with a header line (a dict) holding the util.json, the nodes and
+    # variables in use and their values, followed by one line per change:
+    # [seconds, address or variable name, control, value]. a change of a node
+    # has the control that changed (ST for the status, e.g. CLIHUM for an aux
+    # property), a change of a variable has VAR and a command has CMD (ERR when
+    # the isy did not accept it) with the level sent. the lines are put on a
+    # queue and written by a background thread, like the report lines, so the
+    # pyisy callbacks never wait on the disk. the file is line buffered so a
+    # crash loses at most the lines still queued
+
+    # FIELDS
+    #
+    # path: the file the recording is appended to
+    # config_path: the util.json copied into the header
+    # file: the open file while recording, only written by the writer thread
+    # lines: the queue of lines waiting to be written, None ends the writer thread
+    # writer: the background thread writing the queued lines, None when not recording
+    # started: the monotonic time the recording started
+    # controller: the main.Controller being recorded
+    # nodes: the nodes being recorded, keyed by address
+    # states: the last recorded state of every node, keyed by address
+    # variables: the variables being recorded, keyed by name
+    # subscribers: the listeners on the status events of the nodes and variables
+    # entries: the number of lines written after the header
+
+    # this is the constructor method
+    def __init__(self, path, config_path=config.CONFIG_PATH):
+        self.path = path
+        self.config_path = config_path
+        self.file = None
+        self.lines = queue.SimpleQueue()
+        self.writer = None
+        self.started = None
+        self.controller = None
+        self.nodes = {}
+        self.states = {}
+        self.variables = {}
+        self.subscribers = []
+        self.entries = 0
+
+    def start(self, controller):
+        with open(self.config_path, "r") as file:
+            config_data = json.load(file)
+
+        keys = snapshot.nodes_in_use(controller)
+        self.nodes = {node.address: node for node in keys.values()}
+        self.states = {address: node_state(node) for address, node in self.nodes.items()}
+        self.variables = {name: variable for name, variable in controller.variables.variables.items()
+                          if variable is not None}
+
+        header = {
+            "version": RECORD_VERSION,
+            "time": time.time(),
+            "config": config_data,
+            "nodes": {address: node.name for address, node in self.nodes.items()},
+            "keys": {key: node.address for key, node in keys.items()},
+            "states": self.states,
+            "variables": {name: variable.status for name, variable in self.variables.items()},
+        }
+
+        self.file = open(self.path, "a", buffering=1)
+        self.started = time.monotonic()
+        self.write(header)
+        self.writer = threading.Thread(target=self.write_lines, name="recorder", daemon=True)
+        self.writer.start()
+
+        for address, node in self.nodes.items():
+            self.subscribers.append(node.status_events.subscribe(self.node_changed, key=address))
+        for name, variable in self.variables.items():
+            self.subscribers.append(variable.status_events.subscribe(self.variable_changed, key=name))
+        self.controller = controller
+        controller.actuator.recorder = self
+
+    def stop(self):
+        for subscriber in self.subscribers:
+            subscriber.unsubscribe()
+        self.subscribers = []
+        if self.controller is not None and self.controller.actuator.recorder is self:
+            self.controller.actuator.recorder = None
+        if self.writer is not None:
+            self.append(None, END, None)
+            # waits until every queued line is written
+            self.lines.put(None)
+            self.writer.join()
+            self.writer = None
+            self.file.close()
+            self.file = None
+        _LOGGER.warning("Recorded %d changes and commands to %s", self.entries, self.path)
+
+    def write(self, line):
+        self.lines.put(line)
+
+    # runs in the writer thread
+    def write_lines(self):
+        while True:
+            line = self.lines.get()
+            if line is None:
+                return
+            try:
+                self.file.write(json.dumps(line, separators=(",", ":")) + "\n")
+            except (OSError, TypeError, ValueError):
+                _LOGGER.exception("Could not write to the recording %s", self.path)
+
+    def append(self, target, control, value):
+        self.write([round(time.monotonic() - self.started, 3), target, control, value])
+        self.entries += 1
+
+    # pyisy does not say what changed, so the node is compared to what was recorded last
+    def node_changed(self, event, address):
+        if self.writer is None:
+            return
+        state = node_state(self.nodes[address])
+        last = self.states[address]
+        for control, value in state.items():
+            if last.get(control) != value:
+                self.append(address, control, value)
+        self.states[address] = state
+
+    def variable_changed(self, event, name):
+        if self.writer is not None:
+            self.append(name, VARIABLE, self.variables[name].status)
+
+    def command(self, address, level, success):
+        if self.writer is not None:
+            self.append(address, COMMAND if success else FAILED, level)
+
+
+# reads a recording. every start of main.py appends a new session, so this
+# returns a list of (header, entries), one per session. a line cut short by a
+# crash is skipped
+def load(path):
+    sessions = []
+    with open(path, "r") as file:
+        for line in file:
+            try:
+                line = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(line, dict):
+                if line.get("version") != RECORD_VERSION:
+                    raise ValueError("{} was recorded with version {}, not {}".format(
+                        path, line.get("version"), RECORD_VERSION))
+                sessions.append((line, []))
+            elif sessions:
+                sessions[-1][1].append(tuple(line))
+    return sessions
+
+
+class ReplayLoop(asyncio.SelectorEventLoop):
+
+    # an event loop whose clock stands still until jump moves it on, so the
+    # hold timers of the rooms fire at the time of the log without waiting for it
+
+    # FIELDS
+    #
+    # now: the time of the loop
+
+    # this is the constructor method
+    def __init__(self):
+        super().__init__()
+        self.now = 0
+
+    def time(self):
+        return self.now
+
+    def jump(self, when):
+        if when > self.now:
+            self.now = when
+
+
+class Replayer:
+
+    # feeds one recorded session to the control logic of main.py on a fake isy
+    # and collects the commands it sends. a tick follows every group of changes
+    # with the same time, like the event driven loop, and every hold time,
+    # travel of the damper or warmup of a supply that runs out in between. commands take no time on the fake isy,
+    # so as fast as possible a change that raced a command within the latency
+    # of the real isy can come out in another order than recorded
+
+    # FIELDS
+    #
+    # header: the header of the session
+    # entries: the changes of the session, as (seconds, target, control, value)
+    # realtime: whether the changes are fed at the speed they were recorded
+    # isy: the FakeISY standing in for the recorded nodes and variables
+    # controller: the main.Controller being replayed
+    # origin: the loop time of the start of the session
+    # commands: the commands sent, as (seconds, address, level)
+
+    # this is the constructor method
+    # registry: the config.Registry to replay with, the recorded one if not given
+    def __init__(self, header, entries, registry=None, realtime=False):
+        self.header = header
+        self.entries = entries
+        self.realtime = realtime
+        if registry is None:
+            registry = config.Registry(*config.parse(header["config"]))
+
+        self.isy = FakeISY()
+        for address, name in header["nodes"].items():
+            self.isy.add_node(address, name)
+            for control, value in header["states"][address].items():
+                self.isy.apply(address, control, value)
+        for name, value in header["variables"].items():
+            self.isy.variables.add(name, value)
+
+        accumulator = CFMAccumulator()
+        exhaust_fans_object = ExhaustFans(self.isy, registry.exhaust_fans, accumulator)
+        supply_fans_object = SupplyFans(self.isy, registry.supplies, accumulator)
+        actuator = Actuator(main.COMMAND_DEBOUNCE)
+        variables = Variables(self.isy)
+        variables.bind_all(registry.variables)
+        humidity_controller = humidity.Humidity(self.isy, registry, actuator, variables)
+        self.controller = main.Controller(self.isy, exhaust_fans_object, supply_fans_object,
+                                          humidity_controller, variables)
+        actuator.recorder = self
+        self.origin = 0
+        self.commands = []
+
+    def elapsed(self):
+        return asyncio.get_running_loop().time() - self.origin
+
+    def command(self, address, level, success):
+        self.commands.append((round(self.elapsed(), 3), address, level))
+
+    async def wait(self, seconds):
+        loop = asyncio.get_running_loop()
+        if self.realtime:
+            await asyncio.sleep(max(0, self.origin + seconds - loop.time()))
+        else:
+            loop.jump(self.origin + seconds)
+            # lets the timers that are now due run
+            await asyncio.sleep(0)
+
+    # ticks for every hold time, travel of the damper and warmup of a supply that runs out before seconds
+    async def run_until(self, seconds):
+        controller = self.controller
+        while True:
+            timers = list(controller.humidity_controller.timers.values())
+            if controller.damper is not None and controller.damper.timer is not None:
+                timers.append(controller.damper.timer)
+            if controller.warmup_timer is not None:
+                timers.append(controller.warmup_timer)
+            deadlines = [timer.when() - self.origin for timer in timers]
+            if not deadlines or min(deadlines) > seconds:
+                break
+            await self.wait(min(deadlines))
+            await asyncio.sleep(0)
+            await self.tick()
+        await self.wait(seconds)
+
+    # the tick only queues its commands, they are sent before the next change is fed
+    async def tick(self, full=False):
+        await self.controller.tick(full)
+        await self.controller.actuator.drain()
+
+    async def run(self):
+        self.origin = asyncio.get_running_loop().time()
+        self.controller.subscribe()
+        try:
+            await self.tick(full=True)
+            for seconds, group in itertools.groupby(self.entries, key=lambda entry: entry[0]):
+                await self.run_until(seconds)
+                for _, target, control, value in group:
+                    # the recorded commands are what the replay is compared to
+                    if control not in (COMMAND, FAILED, END):
+                        self.isy.apply(target, control, value)
+                await self.tick()
+        finally:
+            self.controller.unsubscribe()
+            await self.controller.actuator.stop()
+            self.controller.variables.close()
+            for room in list(self.controller.humidity_controller.timers):
+                self.controller.humidity_controller.disarm(room)
+            if self.controller.damper is not None:
+                self.controller.damper.cancel()
+            self.controller.arm_warmup(None, None)
+        return self.commands
+
+
+# the commands of the session that the isy accepted, as (seconds, address, level)
+def recorded_commands(entries):
+    return [(seconds, target, value) for seconds, target, control, value in entries if control == COMMAND]
+
+
+# the differences between the recorded and the replayed commands, in the style
+# of a unified diff: "-" for a recorded command the replay did not send, "+" for
+# one the replay sent that was not recorded. the times are not compared
+def diff(recorded, replayed):
+    matcher = difflib.SequenceMatcher(a=[command[1:] for command in recorded],
+                                      b=[command[1:] for command in replayed],
+                                      autojunk=False)
+    lines = []
+    for tag, a_start, a_end, b_start, b_end in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        for seconds, address, level in recorded[a_start:a_end]:
+            lines.append("- {:>12.3f}s {} {}".format(seconds, address, level))
+        for seconds, address, level in replayed[b_start:b_end]:
+            lines.append("+ {:>12.3f}s {} {}".format(seconds, address, level))
+    return lines
+
+
+def replay_session(header, entries, registry=None, realtime=False):
+    replayer = Replayer(header, entries, registry, realtime)
+    if realtime:
+        return asyncio.run(replayer.run())
+    loop = ReplayLoop()
+    try:
+        return loop.run_until_complete(replayer.run())
+    finally:
+        loop.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay a recording through the control logic and diff the commands.")
+    parser.add_argument("recording", help="file written with RECORD_PATH")
+    parser.add_argument("--config", help="util.json to replay with instead of the recorded one")
+    parser.add_argument("--realtime", action="store_true", help="replay at the speed it was recorded")
+    parser.add_argument("--session", type=int, help="only replay this session, counting from 0")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    registry = config.load_registry(args.config) if args.config else None
+    sessions = load(args.recording)
+    if args.session is not None:
+        sessions = sessions[args.session:args.session + 1]
+
+    differences = 0
+    for header, entries in sessions:
+        start = time.perf_counter()
+        replayed = replay_session(header, entries, registry, args.realtime)
+        recorded = recorded_commands(entries)
+        lines = diff(recorded, replayed)
+        print("session of {}: {:.0f}s recorded, replayed in {:.2f}s, {} commands recorded, {} replayed".format(
+            time.ctime(header["time"]), entries[-1][0] if entries else 0, time.perf_counter() - start,
+            len(recorded), len(replayed)))
+        for line in lines:
+            print(line)
+        differences += len(lines)
+
+    if differences:
+        sys.exit(1)
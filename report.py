@@ -0,0 +1,102 @@
+import json
+import logging
+import queue
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+JSON = "json"
+HUMAN = "human"
+
+
+class DeferredQueueHandler(QueueHandler):
+
+    # the standard QueueHandler formats the record in the thread that logs it.
+    # here the record is queued as it is and formatted by the listener thread
+
+    def prepare(self, record):
+        return record
+
+
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record):
+        if isinstance(record.msg, dict):
+            return json.dumps(record.msg, separators=(",", ":"), default=str)
+        return super().format(record)
+
+
+class Reporter:
+
+    # writes what the control loop did. in json mode a record is written as one
+    # json line when the state changed since the last record, and at least every
+    # summary_interval seconds. in human mode the verbose console dump is written
+    # on every tick, for debugging. either way the lines are put on a queue and
+    # written by a background thread, so a slow stdout never stalls the loop
+
+    # FIELDS
+    #
+    # mode: JSON or HUMAN
+    # summary_interval: seconds after which a record is written even if nothing changed
+    # fields: added to every json record, e.g. the name of the site
+    # last_state: the state of the last record written
+    # last_time: the monotonic time the last record was written
+    # logger: the logger the records go through
+    # listener: the background thread writing the queued records to the stream
+
+    # this is the constructor method
+    def __init__(self, mode=JSON, summary_interval=60, stream=None, fields=None):
+        self.mode = mode
+        self.summary_interval = summary_interval
+        self.fields = fields or {}
+        self.last_state = None
+        self.last_time = None
+
+        records = queue.SimpleQueue()
+        handler = logging.StreamHandler(stream or sys.stdout)
+        handler.setFormatter(JSONFormatter("%(message)s"))
+        self.listener = QueueListener(records, handler)
+
+        self.logger = logging.getLogger("{}.{}".format(__name__, id(self)))
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(DeferredQueueHandler(records))
+
+    def start(self):
+        self.listener.start()
+
+    # waits until every queued line is written
+    def stop(self):
+        self.listener.stop()
+
+    # state: a dict of what the tick ended with, e.g. the totals and supply levels.
+    # text: a function returning the verbose console dump, only called in human mode.
+    # returns whether anything was written
+    def report(self, state, text=None):
+        if self.mode == HUMAN:
+            if text is not None:
+                self.logger.info(text())
+            return True
+
+        now = time.monotonic()
+        if state != self.last_state:
+            event = "change"
+        elif self.last_time is None or now - self.last_time >= self.summary_interval:
+            event = "summary"
+        else:
+            return False
+
+        self.last_state = state
+        self.last_time = now
+        record = {"time": time.time(), "event": event}
+        record.update(self.fields)
+        record.update(state)
+        self.logger.info(record)
+        return True
+
+    # writes a one-off record, e.g. the damper being opened
+    def event(self, event, **fields):
+        record = {"time": time.time(), "event": event}
+        record.update(self.fields)
+        record.update(fields)
+        self.logger.info(record if self.mode == JSON else "{}: {}".format(event, fields))
@@ -0,0 +1,251 @@
+import asyncio
+import logging
+import os
+import time
+
+from aiohttp import web
+
+from humidity import reported_hum
+
+STATIC_DIR = os.path.dirname(os.path.abspath(__file__))
+# the content type prometheus expects for the text exposition format
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def fan_status(fan):
+    return {
+        "node": fan.spec.node_name,
+        "name": fan.name,
+        "kind": fan.kind,
+        "role": fan.spec.role,
+        "cfm": fan.cfm,
+        "type": fan.type,
+        "value": fan.value,
+        "time_off": fan.time_off,
+    }
+
+
+# the humidity of the room, None if the sensor has not reported it yet
+def humidity(room):
+    return reported_hum(room.sens_hum)
+
+
+def room_status(room, now):
+    return {
+        "sensor": room.sens_hum.name,
+        "fan": room.fan.name,
+        "humidity": humidity(room),
+        "hum": room.hum,
+        "smoothed": room.smoothed_at(now) if room.read_at is not None else None,
+        "humid": room.humid,
+        "motion": room.sens_motion.status,
+        "hum_remaining": max(0, room.hum_until - now),
+        "motion_remaining": max(0, room.motion_until - now),
+    }
+
+
+# the exhaust cfm by category, None unless the fans are kept in a fantable.FanTable
+def exhaust_by_category(controller):
+    by_category = getattr(controller.accumulator, "exhaust_by_category", None)
+    return by_category() if by_category is not None else None
+
+
+# everything the controller knows, from its in-memory state only
+def status(controller):
+    now = asyncio.get_running_loop().time()
+    actuator = controller.actuator
+    return {
+        "time": time.time(),
+        "ticks": controller.ticks,
+        "last_tick": controller.last_tick,
+        "iaq": controller.iaq_on(),
+        "connected": controller.connected,
+        "exhaust_cfm": controller.accumulator.exhaust,
+        "supply_cfm": controller.accumulator.supply,
+        "net_cfm": controller.net_cfm,
+        "exhaust_by_category": exhaust_by_category(controller),
+        "exhaust_fans": [fan_status(fan) for fan in controller.exhaust_fans_object.dict.values()],
+        "supplies": [fan_status(fan) for fan in controller.supply_fans_object.dict.values()],
+        "rooms": [room_status(room, now) for room in controller.humidity_controller.rooms],
+        "commands": {"sent": actuator.sent, "coalesced": actuator.coalesced, "retried": actuator.retried,
+                     "failed": actuator.failed, "queued": len(actuator.queued), "in_flight": len(actuator.in_flight)},
+        "events": {"received": controller.events.received, "merged": controller.events.merged,
+                   "dropped": controller.events.dropped, "pending": len(controller.events)},
+        "damper": controller.damper.state if controller.damper is not None else None,
+        "profile": controller.profiler.summary(),
+        "overruns": controller.profiler.overruns,
+        "last_actions": [
+            {"time": sent, "node": address, "level": level, "success": success}
+            for sent, address, level, success in actuator.history
+        ],
+    }
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def number(value):
+    if value is None or value is True or value is False:
+        return int(bool(value))
+    return value
+
+
+# the state of the controller as prometheus metric families, as
+# {name: (type, help, [(labels, value)])}, see render. labels are added to every sample,
+# so the families of many controllers can be merged, see supervisor.py
+def metric_families(controller, labels=None):
+    now = asyncio.get_running_loop().time()
+    actuator = controller.actuator
+    labels = labels or {}
+    families = {}
+
+    def metric(name, kind, help_text, samples):
+        family = families.setdefault(name, (kind, help_text, []))
+        for sample in samples:
+            family[2].append((dict(labels, **sample[0]),) + tuple(sample[1:]))
+
+    metric("isy_exhaust_cfm", "gauge", "Total exhaust cfm.", [({}, controller.accumulator.exhaust)])
+    metric("isy_supply_cfm", "gauge", "Total supply cfm.", [({}, controller.accumulator.supply)])
+    categories = exhaust_by_category(controller)
+    if categories is not None:
+        metric("isy_exhaust_cfm_by_category", "gauge", "Exhaust cfm of the VentaHood and all other exhaust fans.",
+               [({"category": category}, cfm) for category, cfm in categories.items()])
+    if controller.net_cfm is not None:
+        metric("isy_net_cfm", "gauge", "Net cfm the last balance ended with.", [({}, controller.net_cfm)])
+    metric("isy_iaq_on", "gauge", "Whether the IAQ_on_off variable is on.", [({}, controller.iaq_on())])
+    metric("isy_connected", "gauge", "Whether the node statuses are current.", [({}, controller.connected)])
+
+    fans = list(controller.exhaust_fans_object.dict.values()) + list(controller.supply_fans_object.dict.values())
+    metric("isy_fan_level", "gauge", "Current level of the fan.",
+           [({"fan": fan.name, "kind": fan.kind}, fan.value) for fan in fans])
+
+    rooms = controller.humidity_controller.rooms
+    metric("isy_room_humidity", "gauge", "Humidity reported by the room sensor.",
+           [({"room": room.sens_hum.name}, humidity(room)) for room in rooms if humidity(room) is not None])
+    metric("isy_room_hold_seconds", "gauge", "Seconds the room fan is still held on.",
+           [({"room": room.sens_hum.name, "reason": "humidity"}, max(0, room.hum_until - now)) for room in rooms]
+           + [({"room": room.sens_hum.name, "reason": "motion"}, max(0, room.motion_until - now)) for room in rooms])
+
+    metric("isy_ticks_total", "counter", "Control ticks run.", [({}, controller.ticks)])
+    if controller.last_tick is not None:
+        metric("isy_last_tick_timestamp_seconds", "gauge", "When the last tick finished.",
+               [({}, controller.last_tick)])
+    metric("isy_commands_sent_total", "counter", "Commands sent to the isy.", [({}, actuator.sent)])
+    metric("isy_commands_coalesced_total", "counter", "Commands dropped as repeated or superseded.",
+           [({}, actuator.coalesced)])
+    metric("isy_commands_retried_total", "counter", "Commands sent again after a failure or timeout.",
+           [({}, actuator.retried)])
+    metric("isy_commands_failed_total", "counter", "Commands given up after their deadline.",
+           [({}, actuator.failed)])
+    metric("isy_commands_queued", "gauge", "Commands waiting for or on their way to the isy.",
+           [({}, len(actuator.queued) + len(actuator.in_flight))])
+    metric("isy_events_received_total", "counter", "Node events put into the event buffer.",
+           [({}, controller.events.received)])
+    metric("isy_events_merged_total", "counter", "Node events that replaced a pending event of the same node.",
+           [({}, controller.events.merged)])
+    metric("isy_events_dropped_total", "counter", "Node events dropped because the event buffer was full.",
+           [({}, controller.events.dropped)])
+    metric("isy_events_pending", "gauge", "Nodes with a change waiting for the next tick.",
+           [({}, len(controller.events))])
+    summary = controller.profiler.summary()
+    samples = []
+    for stage, stats in summary.items():
+        for fraction, seconds in stats["quantiles"].items():
+            samples.append(({"stage": stage, "quantile": fraction}, seconds))
+        samples.append(({"stage": stage}, stats["sum"], "_sum"))
+        samples.append(({"stage": stage}, stats["count"], "_count"))
+    metric("isy_stage_seconds", "summary", "Time spent in every stage of the tick and every command.", samples)
+    metric("isy_tick_overruns_total", "counter", "Ticks that took longer than the period.",
+           [({}, controller.profiler.overruns)])
+    if controller.telemetry is not None:
+        metric("isy_telemetry_dropped_total", "counter", "Telemetry snapshots dropped because the buffer was full.",
+               [({}, controller.telemetry.dropped)])
+    return families
+
+
+# adds the families of other to families
+def merge_families(families, other):
+    for name, (kind, help_text, samples) in other.items():
+        families.setdefault(name, (kind, help_text, []))[2].extend(samples)
+    return families
+
+
+# the metric families in the prometheus text format. a sample is (labels, value),
+# or (labels, value, suffix) for the _sum and _count of a summary
+def render(families):
+    lines = []
+    for name, (kind, help_text, samples) in families.items():
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for sample in samples:
+            labels, value = sample[0], sample[1]
+            sample_name = name + sample[2] if len(sample) > 2 else name
+            if labels:
+                label_text = ",".join('{}="{}"'.format(key, escape(label)) for key, label in labels.items())
+                lines.append("{}{{{}}} {}".format(sample_name, label_text, number(value)))
+            else:
+                lines.append("{} {}".format(sample_name, number(value)))
+    lines.append("")
+    return "\n".join(lines)
+
+
+# the same state in the prometheus text format
+def metrics(controller):
+    return render(metric_families(controller))
+
+
+class StatusServer:
+
+    # serves the status page, a json snapshot of the controller and prometheus
+    # metrics from the same event loop as the control loop. every response is
+    # built from the state the controller already has in memory, so a scrape
+    # never sends a request to the isy and never waits on the control tick
+
+    # FIELDS
+    #
+    # controller: the main.Controller whose state is served
+    # host: the address the server listens on
+    # port: the port the server listens on
+    # runner: the aiohttp runner of the server
+
+    # this is the constructor method
+    def __init__(self, controller, host="0.0.0.0", port=4002):
+        self.controller = controller
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/", self.index)
+        app.router.add_get("/style.css", self.style)
+        app.router.add_get("/status.json", self.status)
+        app.router.add_get("/metrics", self.metrics)
+        return app
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app(), access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        _LOGGER.info("Serving the status page on port %s", self.port)
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def index(self, request):
+        return web.FileResponse(os.path.join(STATIC_DIR, "index.html"))
+
+    async def style(self, request):
+        return web.FileResponse(os.path.join(STATIC_DIR, "style.css"))
+
+    async def status(self, request):
+        return web.json_response(status(self.controller))
+
+    async def metrics(self, request):
+        return web.Response(body=metrics(self.controller).encode("utf-8"),
+                            headers={"Content-Type": METRICS_CONTENT_TYPE})
@@ -0,0 +1,222 @@
+import logging
+import os
+import pickle
+import time
+
+from pyisy.constants import CMD_OFF, CMD_ON, METHOD_COMMAND, URL_NODES
+from pyisy.helpers import EventEmitter, NodeProperty
+
+# bump this whenever the layout of the snapshot changes so old ones are ignored
+SNAPSHOT_VERSION = 1
+
+_LOGGER = logging.getLogger(__name__)
+
+
+# every node the controller uses, keyed by the name or address util.json uses for it
+def nodes_in_use(controller):
+    keys = {}
+    for fans_object in (controller.exhaust_fans_object, controller.supply_fans_object):
+        for node_name, fan in fans_object.dict.items():
+            keys[node_name] = fan.node
+    for key, room in controller.humidity_controller.by_key.items():
+        for node_key, node in zip(key, (room.sens_hum, room.sens_motion, room.fan)):
+            keys[node_key] = node
+    return keys
+
+
+# writes the nodes and variables the controller uses to path: the address,
+# name, type, status and aux properties of every node, the key (name or
+# address) it is looked up by, and the address (type.id) and value of every variable
+def save(path, controller):
+    keys = nodes_in_use(controller)
+
+    nodes = {}
+    for node in keys.values():
+        aux = {control: (prop.value, prop.prec, prop.uom) for control, prop in node.aux_properties.items()}
+        nodes[node.address] = (node.name, getattr(node, "type", None), node.status, aux)
+
+    variables = {}
+    for name, variable in controller.variables.variables.items():
+        if variable is not None:
+            variables[name] = (getattr(variable, "address", None), variable.status)
+
+    data = {
+        "time": time.time(),
+        "keys": {key: node.address for key, node in keys.items()},
+        "nodes": nodes,
+        "variables": variables,
+    }
+
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as file:
+            pickle.dump((SNAPSHOT_VERSION, data), file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError as err:
+        _LOGGER.warning("Could not write the snapshot %s: %s", path, err)
+
+
+# returns what save wrote, or None if there is no usable snapshot
+def load(path):
+    try:
+        with open(path, "rb") as file:
+            version, data = pickle.load(file)
+    except (OSError, pickle.PickleError, EOFError, ValueError, TypeError):
+        return None
+    if version != SNAPSHOT_VERSION:
+        return None
+    return data
+
+
+# whether the snapshot has every node and variable the registry uses, plus the given variables
+def covers(data, registry, variables=()):
+    names = set(registry.variables) | set(variables)
+    return all(key in data["keys"] for key in registry.node_names()) and all(name in data["variables"] for name in names)
+
+
+class SnapshotNode:
+
+    # a node restored from a snapshot. its status is the last one saved, and
+    # its commands go straight to the rest api of the isy. since no websocket
+    # reports back before the isy is initialized, the status is set to what
+    # was commanded once the isy accepted the command
+
+    # FIELDS
+    #
+    # isy: the WarmISY the node belongs to
+    # address: the address of the node
+    # name: the english name of the node
+    # type: the isy type of the node
+    # status: the last known status
+    # aux_properties: the last known aux properties, keyed by control
+    # status_events: notified when the status changes
+
+    # this is the constructor method
+    def __init__(self, isy, address, name, node_type, status, aux):
+        self.isy = isy
+        self.address = address
+        self.name = name
+        self.type = node_type
+        self._status = status
+        self.aux_properties = {control: NodeProperty(control, value, prec, uom, address=address)
+                               for control, (value, prec, uom) in aux.items()}
+        self.status_events = EventEmitter()
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, value):
+        if self._status != value:
+            self._status = value
+            self.status_events.notify({"address": self.address, "status": value})
+
+    async def turn_on(self, val=None):
+        if val is not None and int(val) <= 0:
+            return await self.turn_off()
+        path = [URL_NODES, self.address, METHOD_COMMAND, CMD_ON]
+        if val is not None and int(val) <= 255:
+            path.append(str(val))
+        return await self.command(path, 255 if val is None else int(val))
+
+    async def turn_off(self):
+        return await self.command([URL_NODES, self.address, METHOD_COMMAND, CMD_OFF], 0)
+
+    async def command(self, path, status):
+        conn = self.isy.conn
+        if not await conn.request(conn.compile_url(path), retry404=True):
+            _LOGGER.warning("ISY could not send %s to %s.", path[-1], self.address)
+            return False
+        self.status = status
+        return True
+
+
+class SnapshotNodes:
+
+    # FIELDS
+    #
+    # by_address: the nodes keyed by address
+    # by_key: the same nodes keyed by the name or address util.json uses for them
+    # status_events: never notified, like the structural events of pyisy
+
+    # this is the constructor method
+    def __init__(self, isy, data):
+        self.by_address = {}
+        for address, (name, node_type, status, aux) in data["nodes"].items():
+            self.by_address[address] = SnapshotNode(isy, address, name, node_type, status, aux)
+        self.by_key = {key: self.by_address[address] for key, address in data["keys"].items()}
+        self.status_events = EventEmitter()
+
+    def __getitem__(self, key):
+        node = self.by_key.get(key) or self.by_address.get(key)
+        if node is None:
+            raise KeyError("Unrecognized Key: [{}]".format(key))
+        return node
+
+    def __contains__(self, key):
+        return key in self.by_key or key in self.by_address
+
+    def __iter__(self):
+        return iter(self.by_address.values())
+
+
+class SnapshotVariable:
+
+    # FIELDS
+    #
+    # name: the name of the variable
+    # address: the type and id of the variable on the isy, as "type.id"
+    # status: the last known value
+    # status_events: never notified, the value only changes once the isy is initialized
+
+    # this is the constructor method
+    def __init__(self, name, address, status):
+        self.name = name
+        self.address = address
+        self.status = status
+        self.status_events = EventEmitter()
+
+
+class SnapshotVariables:
+
+    # this is the constructor method
+    def __init__(self, data):
+        self.by_name = {name: SnapshotVariable(name, address, status)
+                        for name, (address, status) in data["variables"].items()}
+
+    def get_by_name(self, name):
+        return self.by_name.get(name)
+
+    async def update(self, wait_time=0):
+        pass
+
+
+class WarmISY:
+
+    # stands in for the pyisy.ISY while it is initialized in the background,
+    # with the nodes and variables of a snapshot. the rest api, websocket and
+    # events are those of the real isy, so commands work right away.
+    # see main.Controller.rebind for the switch over to the real isy
+
+    # FIELDS
+    #
+    # isy: the real pyisy.ISY
+    # nodes: the SnapshotNodes
+    # variables: the SnapshotVariables
+    # conn: the rest api of the real isy
+    # websocket: the websocket of the real isy
+    # connection_events: the connection events of the real isy
+    # status_events: the system status events of the real isy
+    # age: seconds between the snapshot being written and loaded
+
+    # this is the constructor method
+    def __init__(self, isy, data):
+        self.isy = isy
+        self.nodes = SnapshotNodes(self, data)
+        self.variables = SnapshotVariables(data)
+        self.conn = isy.conn
+        self.websocket = isy.websocket
+        self.connection_events = isy.connection_events
+        self.status_events = isy.status_events
+        self.age = time.time() - data["time"]
@@ -0,0 +1,290 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import time
+from typing import NamedTuple, Optional
+
+from aiohttp import web
+from pyisy.logging import enable_logging
+
+import main
+import server
+
+# seconds a failed site waits before it is started again, doubled on every
+# failure in a row up to RESTART_MAX
+RESTART_MIN = 5
+RESTART_MAX = 300
+# a site that ran this many seconds before failing starts over at RESTART_MIN
+RESTART_RESET = 600
+# seconds between checks of the shard processes
+SHARD_CHECK_PERIOD = 5
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class SiteConfig(NamedTuple):
+    # name: the name of the site, added to its report lines and metrics
+    # url: the address of the isy of the site
+    # username: the isy username
+    # password: the isy password
+    # config_path: the util.json of the site
+    # config_cache: the file the validated util.json is cached in, if any
+    # telemetry_db: the sqlite file the history of the site is kept in, if any
+    # warm_start: the file the snapshot for warm starts of the site is kept in, if any
+    # record: the file the events and commands of the site are recorded to, if any
+    # tls_ver: the tls version used to talk to the isy
+    name: str
+    url: str
+    username: str
+    password: str
+    config_path: str
+    config_cache: Optional[str] = None
+    telemetry_db: Optional[str] = None
+    warm_start: Optional[str] = None
+    record: Optional[str] = None
+    tls_ver: float = 1.1
+
+
+# reads the list of sites, e.g.
+# [{"name": "home", "address": "https://10.0.0.2", "username": "admin",
+#   "password_env": "HOME_PASSWORD", "config": "home.json"}]
+# the password is read from the environment variable password_env, or given as password
+def load_sites(path):
+    with open(path, "r") as file:
+        file_data = json.load(file)
+
+    sites = []
+    names = set()
+    for site in file_data:
+        name = site.get("name")
+        if not name or name in names:
+            raise ValueError("every site needs a unique name, got {!r}".format(name))
+        names.add(name)
+
+        password = site.get("password")
+        if "password_env" in site:
+            password = os.getenv(site["password_env"])
+        if not site.get("address") or password is None:
+            raise ValueError("site {} needs an address and a password".format(name))
+
+        sites.append(SiteConfig(name=name,
+                                url=site["address"],
+                                username=site.get("username", ""),
+                                password=password,
+                                config_path=site.get("config", "util.json"),
+                                config_cache=site.get("config_cache"),
+                                telemetry_db=site.get("telemetry_db"),
+                                warm_start=site.get("warm_start"),
+                                record=site.get("record"),
+                                tls_ver=site.get("tls_ver", 1.1)))
+    return tuple(sites)
+
+
+class SiteRunner:
+
+    # runs the isy connection and control loop of one site as its own task.
+    # whatever goes wrong with the site only restarts that site, after a
+    # backoff, and never touches the other sites in the process
+
+    # FIELDS
+    #
+    # site: the SiteConfig
+    # controller: the main.Controller of the site while it runs
+    # state: "starting", "running", "restarting" or "stopped"
+    # restarts: the number of times the site was started again
+    # failures: the number of failures in a row, for the backoff
+    # last_error: what the last failure was
+    # started: the monotonic time the site was last started
+
+    # this is the constructor method
+    def __init__(self, site):
+        self.site = site
+        self.controller = None
+        self.state = "starting"
+        self.restarts = 0
+        self.failures = 0
+        self.last_error = None
+        self.started = None
+
+    def attach(self, controller):
+        self.controller = controller
+        self.state = "running"
+
+    async def run_site(self):
+        site = self.site
+        await main.main(
+            url=site.url,
+            username=site.username,
+            password=site.password,
+            tls_ver=site.tls_ver,
+            events=True,
+            node_servers=False,
+            event_driven=main.EVENT_DRIVEN,
+            config_path=site.config_path,
+            config_cache=site.config_cache,
+            # the supervisor serves the metrics of all its sites on one port
+            http_port=0,
+            telemetry_db=site.telemetry_db,
+            warm_start=site.warm_start,
+            record=site.record,
+            name=site.name,
+            on_controller=self.attach,
+        )
+
+    async def run(self):
+        while True:
+            self.started = time.monotonic()
+            self.state = "starting"
+            try:
+                await self.run_site()
+                # main returns when it could not connect
+                self.last_error = "the site stopped"
+            except asyncio.CancelledError:
+                self.state = "stopped"
+                raise
+            except Exception as err:
+                self.last_error = repr(err)
+                _LOGGER.exception("Site %s failed", self.site.name)
+            self.controller = None
+
+            if time.monotonic() - self.started > RESTART_RESET:
+                self.failures = 0
+            self.failures += 1
+            self.restarts += 1
+            delay = min(RESTART_MAX, RESTART_MIN * 2 ** (self.failures - 1))
+            delay *= random.uniform(0.5, 1)
+            self.state = "restarting"
+            _LOGGER.warning("Restarting site %s in %.0fs: %s", self.site.name, delay, self.last_error)
+            await asyncio.sleep(delay)
+
+
+class Supervisor:
+
+    # runs many sites in one event loop and serves their metrics together,
+    # every sample labelled with the name of its site
+
+    # FIELDS
+    #
+    # runners: the SiteRunner of every site
+    # host: the address the metrics are served on
+    # port: the port the metrics are served on, 0 to not serve them
+    # tasks: the task of every runner while they run
+
+    # this is the constructor method
+    def __init__(self, sites, host="0.0.0.0", port=main.HTTP_PORT):
+        self.runners = [SiteRunner(site) for site in sites]
+        self.host = host
+        self.port = port
+        self.tasks = []
+
+    async def run(self):
+        runner = None
+        if self.port:
+            app = web.Application()
+            app.router.add_get("/metrics", self.metrics)
+            app.router.add_get("/status.json", self.status)
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, self.host, self.port).start()
+
+        self.tasks = [asyncio.create_task(site_runner.run()) for site_runner in self.runners]
+        try:
+            await asyncio.gather(*self.tasks)
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            if runner is not None:
+                await runner.cleanup()
+
+    def metric_families(self):
+        families = {}
+        sites = {"isy_site_up": ("gauge", "Whether the control loop of the site runs.", []),
+                 "isy_site_restarts_total": ("counter", "Times the site was started again.", [])}
+        for site_runner in self.runners:
+            labels = {"site": site_runner.site.name}
+            sites["isy_site_up"][2].append((labels, site_runner.state == "running"))
+            sites["isy_site_restarts_total"][2].append((labels, site_runner.restarts))
+            if site_runner.controller is not None:
+                server.merge_families(families, server.metric_families(site_runner.controller, labels))
+        return server.merge_families(sites, families)
+
+    async def metrics(self, request):
+        return web.Response(body=server.render(self.metric_families()).encode("utf-8"),
+                            headers={"Content-Type": server.METRICS_CONTENT_TYPE})
+
+    async def status(self, request):
+        sites = {}
+        for site_runner in self.runners:
+            sites[site_runner.site.name] = {
+                "state": site_runner.state,
+                "restarts": site_runner.restarts,
+                "last_error": site_runner.last_error,
+                "status": server.status(site_runner.controller) if site_runner.controller is not None else None,
+            }
+        return web.json_response(sites)
+
+
+def run_shard(sites, port):
+    enable_logging(logging.WARNING)
+    try:
+        asyncio.run(Supervisor(sites, port=port).run())
+    except KeyboardInterrupt:
+        pass
+
+
+# splits the sites over processes processes, each with its own supervisor and
+# event loop. shard i serves its metrics on port + i. a shard process that
+# dies is started again, the other shards keep running
+def run_sharded(sites, processes, port):
+    shards = [sites[i::processes] for i in range(processes)]
+    shards = [shard for shard in shards if shard]
+
+    def start(i):
+        process = multiprocessing.Process(target=run_shard, args=(shards[i], port + i if port else 0),
+                                          name="shard-{}".format(i), daemon=True)
+        process.start()
+        return process
+
+    workers = [start(i) for i in range(len(shards))]
+    try:
+        while True:
+            time.sleep(SHARD_CHECK_PERIOD)
+            for i, process in enumerate(workers):
+                if not process.is_alive():
+                    _LOGGER.warning("Shard %d exited with %s, starting it again", i, process.exitcode)
+                    workers[i] = start(i)
+    finally:
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.join()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the control loops of many isy sites in one process.")
+    parser.add_argument("sites", help="json file listing the sites")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="number of processes to shard the sites over, 0 for one per cpu")
+    parser.add_argument("--port", type=int, default=main.HTTP_PORT,
+                        help="port the metrics are served on, shard i uses port + i")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    enable_logging(logging.WARNING)
+
+    sites = load_sites(args.sites)
+    processes = min(args.processes or os.cpu_count() or 1, len(sites))
+    try:
+        if processes > 1:
+            run_sharded(sites, processes, args.port)
+        else:
+            asyncio.run(Supervisor(sites, port=args.port).run())
+    except KeyboardInterrupt:
+        _LOGGER.warning("KeyboardInterrupt received. Disconnecting!")
@@ -0,0 +1,326 @@
+import collections
+import logging
+import sqlite3
+import threading
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+# seconds covered by one row of each rollup table
+ROLLUPS = {"minute": 60, "hour": 3600}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ticks (
+    time REAL PRIMARY KEY,
+    exhaust INTEGER,
+    supply INTEGER,
+    net INTEGER,
+    iaq INTEGER
+);
+CREATE TABLE IF NOT EXISTS fan_levels (
+    time REAL,
+    fan TEXT,
+    level REAL
+);
+CREATE INDEX IF NOT EXISTS fan_levels_fan_time ON fan_levels (fan, time);
+CREATE TABLE IF NOT EXISTS rooms (
+    time REAL,
+    room TEXT,
+    humidity REAL,
+    motion INTEGER
+);
+CREATE INDEX IF NOT EXISTS rooms_room_time ON rooms (room, time);
+"""
+
+ROLLUP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {name} (
+    time REAL PRIMARY KEY,
+    samples INTEGER,
+    exhaust_avg REAL,
+    exhaust_max INTEGER,
+    supply_avg REAL,
+    supply_max INTEGER,
+    net_avg REAL,
+    net_max INTEGER
+);
+"""
+
+
+# a row for a period that already has one (e.g. written when the site stopped
+# halfway through a minute and started again) is merged with it
+ROLLUP_UPSERT = """
+INSERT INTO {name} VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (time) DO UPDATE SET
+    samples = samples + excluded.samples,
+    exhaust_avg = (exhaust_avg * samples + excluded.exhaust_avg * excluded.samples) / (samples + excluded.samples),
+    exhaust_max = max(exhaust_max, excluded.exhaust_max),
+    supply_avg = (supply_avg * samples + excluded.supply_avg * excluded.samples) / (samples + excluded.samples),
+    supply_max = max(supply_max, excluded.supply_max),
+    net_avg = (net_avg * samples + excluded.net_avg * excluded.samples) / (samples + excluded.samples),
+    net_max = max(net_max, excluded.net_max)
+"""
+
+
+class Snapshot:
+
+    # the state of the site at the end of one tick
+
+    # FIELDS
+    #
+    # time: the wall clock time of the tick
+    # exhaust: the total exhaust cfm
+    # supply: the total supply cfm
+    # net: the net cfm balance_cfm ended with, None when it did not run
+    # iaq: the value of the IAQ_on_off variable
+    # fans: the value of every fan that may have changed, keyed by node name
+    # rooms: (humidity, motion) of every room that may have changed, keyed by the name of its humidity sensor
+    # the fans and rooms that are left out are taken as unchanged
+
+    __slots__ = ("time", "exhaust", "supply", "net", "iaq", "fans", "rooms")
+
+    # this is the constructor method
+    def __init__(self, time, exhaust, supply, net, iaq, fans, rooms):
+        self.time = time
+        self.exhaust = exhaust
+        self.supply = supply
+        self.net = net
+        self.iaq = iaq
+        self.fans = fans
+        self.rooms = rooms
+
+
+class Rollup:
+
+    # aggregates the snapshots of one period (e.g. a minute) into one row
+
+    # FIELDS
+    #
+    # period: the seconds covered by one row
+    # start: the start of the period being aggregated
+    # samples: the number of snapshots in the period
+    # sums: the sums of exhaust, supply and net
+    # maxes: the maximums of exhaust, supply and net
+
+    # this is the constructor method
+    def __init__(self, period):
+        self.period = period
+        self.start = None
+        self.samples = 0
+        self.sums = [0, 0, 0]
+        self.maxes = [None, None, None]
+
+    # adds a snapshot. returns the row of the previous period once a new one starts
+    def add(self, snapshot):
+        start = snapshot.time - snapshot.time % self.period
+        row = None
+        if self.start is not None and start != self.start:
+            row = self.row()
+            self.samples = 0
+            self.sums = [0, 0, 0]
+            self.maxes = [None, None, None]
+        self.start = start
+
+        values = (snapshot.exhaust, snapshot.supply, snapshot.net or 0)
+        self.samples += 1
+        for i, value in enumerate(values):
+            self.sums[i] += value
+            if self.maxes[i] is None or value > self.maxes[i]:
+                self.maxes[i] = value
+        return row
+
+    # a copy to aggregate into, which replaces this one once it was written
+    def copy(self):
+        rollup = Rollup(self.period)
+        rollup.start = self.start
+        rollup.samples = self.samples
+        rollup.sums = list(self.sums)
+        rollup.maxes = list(self.maxes)
+        return rollup
+
+    def row(self):
+        if not self.samples:
+            return None
+        return (self.start, self.samples,
+                self.sums[0] / self.samples, self.maxes[0],
+                self.sums[1] / self.samples, self.maxes[1],
+                self.sums[2] / self.samples, self.maxes[2])
+
+
+class Telemetry:
+
+    # keeps a history of the airflow and humidity of the site.
+    # record only appends the snapshot to an in-memory ring buffer, and a
+    # background thread writes the buffer to an sqlite database (in WAL mode) in
+    # batches, so the control loop never waits on the disk. to keep a month of
+    # 1 second ticks small, the writer only stores what changed since the last
+    # snapshot (plus a full row every keyframe seconds) and keeps per minute and
+    # per hour rollups of the totals, which outlive the raw rows
+
+    # FIELDS
+    #
+    # path: the sqlite database file
+    # buffer: the snapshots waiting to be written, oldest first
+    # flush_interval: seconds between batch writes
+    # keyframe: seconds after which a tick is stored even if nothing changed
+    # retention: seconds the raw rows are kept, the rollups are kept for good
+    # dropped: the number of snapshots lost because the buffer was full
+    # thread: the background writer thread
+    # stopping: set to stop the writer
+
+    # this is the constructor method
+    def __init__(self, path, capacity=3600, flush_interval=10, keyframe=60, retention=31 * 24 * 3600):
+        self.path = path
+        self.buffer = collections.deque(maxlen=capacity)
+        self.flush_interval = flush_interval
+        self.keyframe = keyframe
+        self.retention = retention
+        self.dropped = 0
+        self.thread = None
+        self.stopping = threading.Event()
+
+        # only used by the writer thread
+        self.last = None
+        self.last_fans = {}
+        self.last_rooms = {}
+        self.rollups = {name: Rollup(period) for name, period in ROLLUPS.items()}
+        self.last_cleanup = 0
+
+    # called from the control loop, never blocks
+    def record(self, snapshot):
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append(snapshot)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="telemetry", daemon=True)
+        self.thread.start()
+
+    # stops the writer after it wrote what is left in the buffer and the rollups of the current periods
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def run(self):
+        connection = self.connect()
+        with connection:
+            connection.executescript(SCHEMA)
+            for name in ROLLUPS:
+                connection.executescript(ROLLUP_SCHEMA.format(name=name))
+
+        try:
+            while not self.stopping.wait(self.flush_interval):
+                self.flush(connection)
+            self.flush(connection, final=True)
+        finally:
+            connection.close()
+
+    # final: whether the writer stops, the rollups of the periods not yet over are written as well
+    def flush(self, connection, final=False):
+        snapshots = []
+        while self.buffer:
+            snapshots.append(self.buffer.popleft())
+        if not snapshots and not final:
+            return
+
+        try:
+            with connection:
+                state = self.write(connection, snapshots, final)
+                if time.time() - self.last_cleanup > 3600:
+                    self.cleanup(connection)
+        except sqlite3.Error as err:
+            # the state stays at the last write, so the next changes are stored against what is in the database
+            _LOGGER.error("Could not write %d telemetry snapshots: %s", len(snapshots), err)
+            return
+        self.last, self.last_fans, self.last_rooms, self.rollups = state
+
+    # writes the changes in the snapshots and returns the (last, last_fans,
+    # last_rooms, rollups) they lead to, which flush only keeps once they are committed
+    def write(self, connection, snapshots, final=False):
+        ticks, fans, rooms = [], [], []
+        rollups = {name: [] for name in ROLLUPS}
+        last = self.last
+        last_fans = dict(self.last_fans)
+        last_rooms = dict(self.last_rooms)
+        rollup_state = {name: rollup.copy() for name, rollup in self.rollups.items()}
+
+        for snapshot in snapshots:
+            totals = (snapshot.exhaust, snapshot.supply, snapshot.net, snapshot.iaq)
+            if (last is None or totals != last[1:]
+                    or snapshot.time - last[0] >= self.keyframe):
+                ticks.append((snapshot.time,) + totals)
+                last = (snapshot.time,) + totals
+
+            for fan, level in snapshot.fans.items():
+                if last_fans.get(fan) != level:
+                    fans.append((snapshot.time, fan, level))
+                    last_fans[fan] = level
+
+            for room, reading in snapshot.rooms.items():
+                if last_rooms.get(room) != reading:
+                    rooms.append((snapshot.time, room) + tuple(reading))
+                    last_rooms[room] = reading
+
+            for name, rollup in rollup_state.items():
+                row = rollup.add(snapshot)
+                if row is not None:
+                    rollups[name].append(row)
+
+        if final:
+            for name, rollup in rollup_state.items():
+                row = rollup.row()
+                if row is not None:
+                    rollups[name].append(row)
+                rollup_state[name] = Rollup(rollup.period)
+
+        connection.executemany("INSERT OR REPLACE INTO ticks VALUES (?, ?, ?, ?, ?)", ticks)
+        connection.executemany("INSERT INTO fan_levels VALUES (?, ?, ?)", fans)
+        connection.executemany("INSERT INTO rooms VALUES (?, ?, ?, ?)", rooms)
+        for name, rows in rollups.items():
+            connection.executemany(ROLLUP_UPSERT.format(name=name), rows)
+        return last, last_fans, last_rooms, rollup_state
+
+    def cleanup(self, connection):
+        self.last_cleanup = time.time()
+        oldest = self.last_cleanup - self.retention
+        for table in ("ticks", "fan_levels", "rooms"):
+            connection.execute("DELETE FROM {} WHERE time < ?".format(table), (oldest,))
+
+    # returns the totals between start and end, oldest first.
+    # resolution is "raw" for the stored ticks, or "minute" / "hour" for the rollups.
+    # reads from its own connection, so it can run on any thread
+    def query(self, start, end, resolution="raw"):
+        if resolution == "raw":
+            sql = "SELECT time, exhaust, supply, net, iaq FROM ticks WHERE time >= ? AND time < ? ORDER BY time"
+        elif resolution in ROLLUPS:
+            sql = "SELECT * FROM {} WHERE time >= ? AND time < ? ORDER BY time".format(resolution)
+        else:
+            raise ValueError("unknown resolution: {}".format(resolution))
+        return self.select(sql, (start, end))
+
+    # returns (time, level) every time the fan changed between start and end
+    def fan_history(self, fan, start, end):
+        return self.select("SELECT time, level FROM fan_levels WHERE fan = ? AND time >= ? AND time < ? ORDER BY time",
+                           (fan, start, end))
+
+    # returns (time, humidity, motion) every time the room changed between start and end
+    def room_history(self, room, start, end):
+        return self.select("SELECT time, humidity, motion FROM rooms WHERE room = ? AND time >= ? AND time < ? "
+                           "ORDER BY time", (room, start, end))
+
+    def select(self, sql, parameters):
+        connection = sqlite3.connect(self.path)
+        try:
+            return connection.execute(sql, parameters).fetchall()
+        except sqlite3.OperationalError:
+            # the writer has not created the tables yet
+            return []
+        finally:
+            connection.close()
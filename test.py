@@ -1,13 +1,204 @@
-import os
-import requests
-import time
-import json
+import asyncio
+import sys
+
+import aiohttp
+from aiohttp import web
+
+import config
 import humidity
+import main
+from actuator import Actuator
+from AQITracker import AQITracker
+from fake_isy import FakeISY
+from planner import SupplyPlanner
+from replay import ReplayLoop
+
+# checks the control logic against the fake isy, without a controller,
+# and the aqi tracker against a local stub of the AirNow api.
+# `python3 test.py` runs every check, prints FAIL with what went wrong for
+# the ones that fail and exits with 1 if any did. the checks run on a
+# replay.ReplayLoop, so the hold times and the debounce are jumped over
+# instead of waited for
+
+
+def check(condition, message, *args):
+    if not condition:
+        raise AssertionError(message.format(*args))
+
+
+# the levels of the commands sent since start, as (address, level)
+def commands(isy, start=0):
+    return [(address, level) for _, address, level in isy.commands[start:]]
+
+
+# moves the loop on to the time when and lets the timers that are due run
+async def jump(when):
+    asyncio.get_running_loop().jump(when)
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+# runs the check with a new actuator and stops the actuator afterwards, even when the check fails
+async def with_actuator(check_function):
+    actuator = Actuator()
+    try:
+        await check_function(actuator)
+    finally:
+        await actuator.stop()
+
+
+# a room turns its fan on at full speed once the humidity reaches hum,
+# and off hum_t after the humidity went below it again
+async def check_humidity_thresholds(actuator):
+    room_spec = config.RoomSpec("Bath Humidity", "Bath Motion", "Bath Fan", hum=60, hum_t=900,
+                                motion_power=77, motion_t=300)
+    registry = config.Registry((), (), (room_spec,))
+    isy = FakeISY.from_registry(registry, humidity=50)
+    humidity_controller = humidity.Humidity(isy, registry, actuator)
+    sensor = isy.nodes["Bath Humidity"]
+    start = asyncio.get_running_loop().time()
+
+    await humidity_controller.check_humidity()
+    await actuator.drain()
+    check(commands(isy) == [], "the fan was commanded below hum: {}", commands(isy))
+
+    sensor.set_property("CLIHUM", 60)
+    await humidity_controller.check_humidity()
+    await actuator.drain()
+    check(commands(isy) == [("Bath Fan", 255)], "the fan did not go to 255 at hum: {}", commands(isy))
+
+    sent = len(isy.commands)
+    await jump(start + 100)
+    sensor.set_property("CLIHUM", 55)
+    await humidity_controller.check_humidity()
+    await jump(start + 999)
+    await actuator.drain()
+    check(commands(isy, sent) == [], "the fan was turned down before hum_t ran out: {}", commands(isy, sent))
+
+    # the timer of the room turns the fan off on its own
+    await jump(start + 1001)
+    await actuator.drain()
+    check(commands(isy, sent) == [("Bath Fan", 0)], "the fan was not turned off after hum_t: {}",
+          commands(isy, sent))
+
+
+# the supplies are filled in order of priority until the exhaust is made up for
+async def check_balance_plan(actuator):
+    supplies = (
+        config.FanSpec("Damper", "Fresh Air", 200, "bool", "supply", config.DAMPER, priority=1),
+        config.FanSpec("Fan 12", "Fresh Air Fan - 12 inch", 400, 255, "supply", priority=2),
+        config.FanSpec("Fan 8", "Fresh Air Fan - 8 inch", 300, 255, "supply", priority=3),
+    )
+    registry = config.Registry((), supplies, ())
+    isy = FakeISY.from_registry(registry)
+    fans = main.SupplyFans(isy, registry.supplies, main.CFMAccumulator())
+    planner = SupplyPlanner(supplies)
+
+    net_cfm = await main.balance_cfm({}, fans.dict, 300, planner, actuator)
+    await actuator.drain()
+    # 200 cfm from the damper, the other 100 from a quarter of the 12 inch fan
+    check(commands(isy) == [("Damper", 255), ("Fan 12", 64)], "unexpected plan for 300 cfm: {}", commands(isy))
+    check(net_cfm == 0, "300 cfm were not made up for, net cfm {}", net_cfm)
+
+    sent = len(isy.commands)
+    fans.update()
+    net_cfm = await main.balance_cfm({}, fans.dict, 0, planner, actuator)
+    await actuator.drain()
+    check(sorted(commands(isy, sent)) == [("Damper", 0), ("Fan 12", 0)],
+          "the supplies were not turned off without exhaust: {}", commands(isy, sent))
+
+
+# a level that was just sent is not sent again while the status catches up,
+# and is sent again once the debounce ran out and the status still does not show it
+async def check_debounce(actuator):
+    isy = FakeISY(status_lag=60)
+    node = isy.add_node("Fan")
+    actuator.debounce = 2
+    start = asyncio.get_running_loop().time()
+
+    for _ in range(3):
+        actuator.turn_on(node, 128)
+        await actuator.flush()
+        await actuator.drain()
+    check(commands(isy) == [("Fan", 128)], "the same level was sent again within the debounce: {}", commands(isy))
+
+    actuator.turn_on(node, 200)
+    await actuator.flush()
+    await actuator.drain()
+    check(commands(isy) == [("Fan", 128), ("Fan", 200)], "a new level was held back by the debounce: {}",
+          commands(isy))
+
+    await jump(start + 3)
+    actuator.turn_on(node, 200)
+    await actuator.flush()
+    await actuator.drain()
+    check(commands(isy)[-1:] == [("Fan", 200)] and len(isy.commands) == 3,
+          "the level was not sent again after the debounce: {}", commands(isy))
+
+
+# the tracker takes the worst aqi of the observations from the url it is given,
+# here a local stub of the AirNow api, and keeps it when a refresh fails
+async def check_aqi_tracker(actuator):
+    responses = [[{"ParameterName": "O3", "AQI": 30}, {"ParameterName": "PM2.5", "AQI": 62}]]
+    queries = []
+
+    async def observations(request):
+        queries.append(dict(request.query))
+        if not responses:
+            return web.Response(status=500)
+        return web.json_response(responses.pop(0))
+
+    app = web.Application()
+    app.router.add_get("/aq/observation/zipCode/current", observations)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    try:
+        async with aiohttp.ClientSession() as session:
+            tracker = AQITracker(session, zip_code="98005", api_key="key",
+                                 url="http://127.0.0.1:{}/aq/observation/zipCode/current".format(port))
+            check(not tracker.aqi_acceptable(), "the aqi was acceptable before the first refresh")
+
+            await tracker.refresh()
+            check(tracker.aqi == 62, "the worst observation was not taken, aqi {}", tracker.aqi)
+            check(not tracker.aqi_acceptable(), "an aqi of 62 was acceptable")
+            check(queries[0].get("zipCode") == "98005" and queries[0].get("api_key") == "key",
+                  "unexpected query: {}", queries[0])
+
+            responses.append([{"ParameterName": "O3", "AQI": 20}])
+            await tracker.refresh()
+            check(tracker.aqi_acceptable(), "an aqi of {} was not acceptable", tracker.aqi)
+
+            try:
+                await tracker.refresh()
+            except aiohttp.ClientResponseError:
+                pass
+            else:
+                check(False, "a failed request did not raise")
+            check(tracker.aqi == 20, "a failed refresh did not keep the last aqi, aqi {}", tracker.aqi)
+    finally:
+        await runner.cleanup()
+
 
-with open("util.json", "r") as file:
-    file_data = json.load(file)
+CHECKS = (check_humidity_thresholds, check_balance_plan, check_debounce, check_aqi_tracker)
 
-    humidity.Humidity(file_data)
 
+def run():
+    failed = 0
+    for check_function in CHECKS:
+        loop = ReplayLoop()
+        try:
+            loop.run_until_complete(with_actuator(check_function))
+            print("ok   {}".format(check_function.__name__))
+        except AssertionError as err:
+            failed += 1
+            print("FAIL {}: {}".format(check_function.__name__, err))
+        finally:
+            loop.close()
+    return failed
 
 
+if __name__ == "__main__":
+    sys.exit(1 if run() else 0)
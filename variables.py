@@ -0,0 +1,96 @@
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Variables:
+
+    # keeps the values of named isy variables without searching the variable
+    # table for them on every tick. every name is looked up once when it is
+    # bound, and its value is kept current from the status events of the
+    # variable. values is replaced as a whole (never changed in place) on
+    # every change, so a tick that takes it once at its start sees the same
+    # values for the whole tick at no cost
+
+    # FIELDS
+    #
+    # isy: the isy object
+    # variables: the bound pyisy variables, keyed by name. None for names the isy does not have
+    # values: the current value of every bound variable, keyed by name
+    # defaults: the value used for a name the isy does not have
+    # subscribers: the listeners on the status events of the bound variables
+    # on_change: called with the name of a variable whenever its value changed
+
+    # this is the constructor method
+    def __init__(self, isy, on_change=None):
+        self.isy = isy
+        self.variables = {}
+        self.values = {}
+        self.defaults = {}
+        self.subscribers = {}
+        self.on_change = on_change
+
+    # looks the variable up and starts following its value.
+    # binding a name that is already bound does nothing
+    def bind(self, name, default=None):
+        if name in self.variables:
+            return
+        self.defaults[name] = default
+
+        variable = self.isy.variables.get_by_name(name)
+        self.variables[name] = variable
+        if variable is None:
+            _LOGGER.warning("The isy has no variable %s, using %r", name, default)
+            self.set(name, default)
+            return
+
+        self.subscribers[name] = variable.status_events.subscribe(self.changed, key=name)
+        self.set(name, variable.status)
+
+    def bind_all(self, names, default=None):
+        for name in names:
+            self.bind(name, default)
+
+    def unbind(self, name):
+        subscriber = self.subscribers.pop(name, None)
+        if subscriber is not None:
+            subscriber.unsubscribe()
+        self.variables.pop(name, None)
+        self.defaults.pop(name, None)
+        values = dict(self.values)
+        values.pop(name, None)
+        self.values = values
+
+    # looks every bound name up again on another isy, e.g. once the
+    # pyisy.ISY a snapshot.WarmISY stood in for is initialized
+    def rebind(self, isy):
+        for subscriber in self.subscribers.values():
+            subscriber.unsubscribe()
+        self.isy = isy
+        self.variables = {}
+        self.subscribers = {}
+        for name, default in list(self.defaults.items()):
+            del self.defaults[name]
+            self.bind(name, default)
+
+    def close(self):
+        for name in list(self.variables):
+            self.unbind(name)
+
+    def changed(self, event, name):
+        variable = self.variables.get(name)
+        if variable is not None and self.set(name, variable.status) and self.on_change is not None:
+            self.on_change(name)
+
+    # returns whether the value changed
+    def set(self, name, value):
+        if name in self.values and self.values[name] == value:
+            return False
+        values = dict(self.values)
+        values[name] = value
+        self.values = values
+        return True
+
+    # the value of the variable, for code outside of a tick
+    def get(self, name):
+        return self.values.get(name, self.defaults.get(name))